@@ -0,0 +1,217 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Caches on top of Django's cache framework, shared between workers.
+
+Configure them in your settings:
+
+* LIZARD_SHAPE_SEARCH_CACHE -- cache alias for search results
+  (default: 'default'). Size bounds and eviction are those of the
+  configured cache backend (i.e. MAX_ENTRIES or memcached's LRU).
+
+* LIZARD_SHAPE_SEARCH_CACHE_TIMEOUT -- seconds (default: one hour).
+
+* LIZARD_SHAPE_SEARCH_CACHE_GRID -- search points are snapped to a grid
+  with cells of this fraction of the search radius (default: 0.1).
+
+* LIZARD_SHAPE_POPUP_CACHE -- cache alias for rendered popups
+  (default: 'default').
+
+* LIZARD_SHAPE_POPUP_CACHE_TIMEOUT -- seconds (default: one day).
+
+* LIZARD_SHAPE_STYLE_CACHE -- cache alias for legend versions, that
+  invalidate the per process mapnik style cache and the tile cache
+  (default: 'default').
+
+Invalidation (of popups and legends) only reaches other worker
+processes through a cache backend they share, i.e. memcached or the
+database cache. With the process local 'locmem' backend, workers keep
+using their old popups, styles and tiles until they restart.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import uuid
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from lizard_shape.indexes import LRUCache
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CACHE = getattr(settings, 'LIZARD_SHAPE_SEARCH_CACHE', 'default')
+SEARCH_CACHE_TIMEOUT = getattr(
+    settings, 'LIZARD_SHAPE_SEARCH_CACHE_TIMEOUT', 60 * 60)
+SEARCH_CACHE_GRID = getattr(settings, 'LIZARD_SHAPE_SEARCH_CACHE_GRID', 0.1)
+POPUP_CACHE = getattr(settings, 'LIZARD_SHAPE_POPUP_CACHE', 'default')
+POPUP_CACHE_TIMEOUT = getattr(
+    settings, 'LIZARD_SHAPE_POPUP_CACHE_TIMEOUT', 24 * 60 * 60)
+POPUP_VERSION_KEY = 'lizard_shape.popup.version'
+POPUP_HITS_KEY = 'lizard_shape.popup.hits'
+POPUP_MISSES_KEY = 'lizard_shape.popup.misses'
+STYLE_CACHE = getattr(settings, 'LIZARD_SHAPE_STYLE_CACHE', 'default')
+# Number of mapnik styles kept per process.
+MAX_STYLES = 256
+
+_styles = LRUCache(MAX_STYLES)
+# Made once: on Django 1.6 every get_cache() call makes a new backend
+# (and for memcached a new connection).
+_search_cache = get_cache(SEARCH_CACHE)
+_popup_cache = get_cache(POPUP_CACHE)
+_style_cache = get_cache(STYLE_CACHE)
+
+
+def _hashed_key(prefix, config):
+    return '%s.%s' % (prefix,
+                      hashlib.md5(repr(config).encode('utf-8')).hexdigest())
+
+
+def search_cache_key(adapter, x, y, radius, max_results):
+    """Return the cache key for a search, or None if it can't be cached.
+
+    The key contains the shapefile and its mtime, so a new upload
+    invalidates it, and the legend and display configuration of the
+    adapter. x and y are snapped to a grid tied to the radius, so
+    nearby hovers share their results.
+    """
+    if not radius:
+        return None
+    try:
+        mtime = os.path.getmtime(adapter.layer_filename)
+    except OSError:
+        return None
+    radius = float('%.3g' % radius)
+    cell = radius * SEARCH_CACHE_GRID
+    config = (
+        adapter.layer_filename, mtime, adapter.prj,
+        adapter.legend_type, adapter.legend_id, adapter.value_field,
+        adapter.search_property_name, adapter.search_property_id,
+        adapter.display_fields, max_results, radius,
+        int(math.floor(x / cell)), int(math.floor(y / cell)))
+    return _hashed_key('lizard_shape.search', config)
+
+
+def get_search_results(cache_key, workspace_item):
+    """Return cached search results, or None."""
+    results = _search_cache.get(cache_key)
+    if results is None:
+        return None
+    for result in results:
+        result['workspace_item'] = workspace_item
+    return results
+
+
+def set_search_results(cache_key, results):
+    """Cache search results. Workspace items are not stored."""
+    stored = [dict((key, value) for key, value in result.items()
+                   if key != 'workspace_item')
+              for result in results]
+    _search_cache.set(cache_key, stored, SEARCH_CACHE_TIMEOUT)
+
+
+def _popup_version(cache):
+    """Return the current popup version, see invalidate_popups."""
+    version = cache.get(POPUP_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(POPUP_VERSION_KEY, version, None)
+        version = cache.get(POPUP_VERSION_KEY, version)
+    return version
+
+
+def invalidate_popups():
+    """Invalidate all cached popups.
+
+    Called when a Shape, ShapeTemplate or ShapeField is saved or
+    deleted.
+    """
+    _popup_cache.set(POPUP_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def _count(cache, key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The counter does not exist (anymore).
+        cache.add(key, 1, None)
+
+
+def popup_cache_key(adapter, identifiers, add_snippet):
+    """Return the cache key of a popup of adapter.html(), or None.
+
+    The key contains the shapefile and its mtime, the layer arguments
+    (legend and display configuration), the workspace item, the sorted
+    identifiers and add_snippet.
+    """
+    try:
+        mtime = os.path.getmtime(adapter.layer_filename)
+    except OSError:
+        return None
+    workspace_item_id = getattr(adapter.workspace_item, 'id', None)
+    config = (
+        adapter.shape_id, adapter.layer_filename, mtime,
+        json.dumps(adapter.layer_arguments, sort_keys=True),
+        workspace_item_id,
+        sorted(json.dumps(identifier, sort_keys=True)
+               for identifier in identifiers or []),
+        bool(add_snippet),
+        _popup_version(_popup_cache))
+    return _hashed_key('lizard_shape.popup', config)
+
+
+def get_popup(cache_key):
+    """Return a cached popup, or None. Counts hits and misses."""
+    popup = _popup_cache.get(cache_key)
+    _count(_popup_cache,
+           POPUP_MISSES_KEY if popup is None else POPUP_HITS_KEY)
+    return popup
+
+
+def set_popup(cache_key, popup):
+    _popup_cache.set(cache_key, popup, POPUP_CACHE_TIMEOUT)
+
+
+def popup_cache_stats():
+    """Return {'hits': ..., 'misses': ...} of the popup cache."""
+    return {'hits': _popup_cache.get(POPUP_HITS_KEY, 0),
+            'misses': _popup_cache.get(POPUP_MISSES_KEY, 0)}
+
+
+def _legend_version_key(legend_type, legend_id):
+    return 'lizard_shape.legend.version.%s.%s' % (legend_type, legend_id)
+
+
+def legend_version(legend_type, legend_id):
+    """Return the current version of a legend, shared by all workers."""
+    key = _legend_version_key(legend_type, legend_id)
+    version = _style_cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        _style_cache.add(key, version, None)
+        # Without a working cache (i.e. DummyCache) every call gets a
+        # new version, so nothing is reused instead of never rebuilt.
+        version = _style_cache.get(key, version)
+    return version
+
+
+def invalidate_legend(legend_type, legend_id):
+    """Give the legend a new version, so its styles are rebuilt."""
+    _style_cache.set(
+        _legend_version_key(legend_type, legend_id), uuid.uuid4().hex, None)
+
+
+def cached_style(legend_type, legend_id, value_field, make_style):
+    """Return the mapnik style of a legend from the per process cache.
+
+    make_style() is called to build the style if it is not cached for
+    the current legend version.
+    """
+    key = (legend_type, legend_id, value_field,
+           legend_version(legend_type, legend_id))
+    style = _styles.get(key)
+    if style is None:
+        style = make_style()
+        _styles.set(key, style)
+    return style
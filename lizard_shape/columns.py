@@ -0,0 +1,374 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Columnar store of the attributes (dbf data) of a shapefile.
+
+Every column is stored as a typed numpy array in <base>.columns/, next
+to the shapefile, indexed by FID. Columns with empty values get an
+extra boolean array marking them. Arrays are opened
+memory mapped and only when they are used.
+
+The store is written by the lizard_shape_prepare management command
+(see lizard_shape.ingest) or on first use. meta.json contains a version
+and the .shp mtime; stores with another version or mtime are rebuilt.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+
+import numpy
+import osgeo.ogr
+
+logger = logging.getLogger(__name__)
+
+VERSION = 2
+META_FILENAME = 'meta.json'
+GEOMETRY_FILENAME = 'has_geometry.npy'
+# OFTInteger64 only exists in GDAL >= 2.
+INTEGER_TYPES = tuple(
+    field_type for field_type in (osgeo.ogr.OFTInteger,
+                                  getattr(osgeo.ogr, 'OFTInteger64', None))
+    if field_type is not None)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def column_store_directory(shp_filename):
+    return os.path.splitext(shp_filename)[0] + '.columns'
+
+
+def _to_python(value):
+    """Convert a numpy scalar to the value OGR would have returned."""
+    value = value.item()
+    if isinstance(value, bytes) and not isinstance(value, str):
+        # Python 3: OGR returns text.
+        value = value.decode('utf-8')
+    return value
+
+
+def _encode(value):
+    if value is None:
+        return b''
+    if isinstance(value, bytes):
+        return value
+    return (u'%s' % value).encode('utf-8')
+
+
+class ColumnStore(object):
+    """
+    Typed numpy arrays for all columns of a shapefile.
+
+    Column names are available with and without trailing spaces.
+    """
+    def __init__(self, shp_filename, meta, directory=None, arrays=None):
+        self.shp_filename = shp_filename
+        self.meta = meta
+        self.count = meta['count']
+        self.directory = directory
+        self.field_names = [field['name'] for field in meta['fields']]
+        self._fields = {}
+        for field in meta['fields']:
+            self._fields[field['name']] = field
+        for field in meta['fields']:
+            self._fields.setdefault(field['name'].strip(), field)
+        self._arrays = arrays or {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def _array(self, filename):
+        if filename not in self._arrays:
+            array = numpy.load(os.path.join(self.directory, filename),
+                               mmap_mode='r')
+            with self._lock:
+                self._arrays[filename] = array
+        return self._arrays[filename]
+
+    def column(self, name):
+        """Return the numpy array of column name."""
+        return self._array(self._fields[name]['file'])
+
+    def nulls(self, name):
+        """Return a boolean array marking empty values, or None."""
+        null_file = self._fields[name].get('null_file')
+        if null_file is None:
+            return None
+        return self._array(null_file)
+
+    def has_geometry(self, fid):
+        return bool(self._array(GEOMETRY_FILENAME)[fid])
+
+    def value(self, name, fid):
+        """Return the value of column name of feature fid."""
+        nulls = self.nulls(name)
+        if nulls is not None and nulls[fid]:
+            return None
+        return _to_python(self.column(name)[fid])
+
+    def row(self, fid):
+        """Return all values of feature fid as dict, including stripped
+        names."""
+        return dict((name, self.value(name, fid)) for name in self._fields)
+
+    def record(self, fid):
+        """Return a FeatureRecord for feature fid."""
+        return FeatureRecord(self, fid)
+
+    def find(self, name, value):
+        """Return the FIDs where column name equals value."""
+        column = self.column(name)
+        if column.dtype.kind == 'S':
+            value = _encode(value)
+        matches = column == value
+        nulls = self.nulls(name)
+        if nulls is not None:
+            matches &= ~nulls
+        return numpy.nonzero(matches)[0].tolist()
+
+
+class FeatureRecord(object):
+    """
+    Read only, dict like view on the attributes of one feature.
+
+    Values are read from the column store when they are asked for. The
+    full dict (with stripped names) is only built when the record is
+    iterated, i.e. by a template. Pickling stores only the shapefile
+    name and the FID.
+    """
+    __slots__ = ('_store', '_fid', '_dict')
+
+    def __init__(self, store, fid):
+        self._store = store
+        self._fid = fid
+        self._dict = None
+
+    def __getitem__(self, name):
+        if name not in self._store:
+            raise KeyError(name)
+        if self._dict is not None:
+            return self._dict[name]
+        return self._store.value(name, self._fid)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return name in self._store
+
+    def _as_dict(self):
+        if self._dict is None:
+            self._dict = self._store.row(self._fid)
+        return self._dict
+
+    def __iter__(self):
+        return iter(self._as_dict())
+
+    def __len__(self):
+        return len(self._as_dict())
+
+    def keys(self):
+        return self._as_dict().keys()
+
+    def values(self):
+        return self._as_dict().values()
+
+    def items(self):
+        return self._as_dict().items()
+
+    def __eq__(self, other):
+        if isinstance(other, FeatureRecord):
+            other = other._as_dict()
+        return self._as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'FeatureRecord(%r, %d)' % (self._store.shp_filename,
+                                          self._fid)
+
+    def __reduce__(self):
+        return (_unpickle_record, (self._store.shp_filename, self._fid))
+
+
+def _unpickle_record(shp_filename, fid):
+    return column_store(shp_filename).record(fid)
+
+
+def _empty_column(field_defn, count):
+    """Return a preallocated array for count values of field_defn."""
+    field_type = field_defn.GetType()
+    if field_type in INTEGER_TYPES:
+        return numpy.zeros(count, dtype=numpy.int64)
+    if field_type == osgeo.ogr.OFTReal:
+        array = numpy.empty(count, dtype=numpy.float64)
+        array.fill(numpy.nan)
+        return array
+    # Strings, and dates as strings. Widened if a value doesn't fit.
+    return numpy.zeros(count, dtype='S%d' % max(field_defn.GetWidth(), 1))
+
+
+def _grow(array, size):
+    """Return array with its last axis grown to size."""
+    grown = numpy.zeros(array.shape[:-1] + (size, ), dtype=array.dtype)
+    if array.dtype.kind == 'f':
+        grown.fill(numpy.nan)
+    grown[..., :array.shape[-1]] = array
+    return grown
+
+
+def _read_columns(shp_filename):
+    """Read all columns of shp_filename into (meta, arrays).
+
+    Values are written into preallocated arrays row by row, so no Python
+    objects are kept per value.
+    """
+    ds = osgeo.ogr.Open(shp_filename)
+    if ds is None:
+        raise IOError("Could not open shapefile %s" % shp_filename)
+    lyr = ds.GetLayer()
+    layer_defn = lyr.GetLayerDefn()
+    field_defns = [layer_defn.GetFieldDefn(i)
+                   for i in range(layer_defn.GetFieldCount())]
+    count = max(lyr.GetFeatureCount(), 0)
+    columns = [_empty_column(field_defn, count) for field_defn in field_defns]
+    nulls = numpy.zeros((len(field_defns), count), dtype=bool)
+    has_geometry = numpy.zeros(count, dtype=bool)
+    # The dbf row number is the FID.
+    row = 0
+    lyr.ResetReading()
+    feat = lyr.GetNextFeature()
+    while feat is not None:
+        if row == len(has_geometry):
+            # More rows than the feature count said.
+            size = 2 * row + 1
+            columns = [_grow(column, size) for column in columns]
+            nulls = _grow(nulls, size)
+            has_geometry = _grow(has_geometry, size)
+        for i, column in enumerate(columns):
+            value = feat.GetField(i)
+            if value is None:
+                nulls[i, row] = True
+                continue
+            if column.dtype.kind == 'S':
+                value = _encode(value)
+                if len(value) > column.dtype.itemsize:
+                    column = columns[i] = column.astype('S%d' % len(value))
+            column[row] = value
+        has_geometry[row] = bool(feat.GetGeometryRef())
+        row += 1
+        feat = lyr.GetNextFeature()
+
+    fields = []
+    arrays = {GEOMETRY_FILENAME: has_geometry[:row]}
+    for i, (field_defn, column) in enumerate(zip(field_defns, columns)):
+        field = {'name': field_defn.GetName(), 'file': '%d.npy' % i}
+        arrays[field['file']] = column[:row]
+        if nulls[i, :row].any():
+            field['null_file'] = '%d.null.npy' % i
+            arrays[field['null_file']] = nulls[i, :row].copy()
+        fields.append(field)
+    meta = {'version': VERSION,
+            'mtime': os.path.getmtime(shp_filename),
+            'count': row,
+            'fields': fields}
+    return meta, arrays
+
+
+def _save(shp_filename, meta, arrays):
+    """Write the store to disk, unless another writer was first.
+
+    A valid store on disk is never replaced, as other processes may be
+    reading from it. The returned store uses the arrays in memory.
+    """
+    directory = column_store_directory(shp_filename)
+    # Per process and thread, others may write the same store.
+    temp_directory = '%s.%d.%d.tmp' % (
+        directory, os.getpid(), threading.current_thread().ident)
+    if os.path.exists(temp_directory):
+        shutil.rmtree(temp_directory)
+    os.mkdir(temp_directory)
+    try:
+        for filename, array in arrays.items():
+            numpy.save(os.path.join(temp_directory, filename), array)
+        with open(os.path.join(temp_directory, META_FILENAME), 'w') as f:
+            json.dump(meta, f)
+        if _read_meta(shp_filename) is not None:
+            logger.info("Column store %s was written by another process.",
+                        directory)
+        else:
+            if os.path.exists(directory):
+                # Stale or incomplete.
+                shutil.rmtree(directory, ignore_errors=True)
+            try:
+                os.rename(temp_directory, directory)
+            except OSError:
+                # Another process wrote the store in the meantime.
+                if not os.path.isdir(directory):
+                    raise
+            else:
+                logger.info("Wrote column store %s (%d rows).",
+                            directory, meta['count'])
+    finally:
+        if os.path.exists(temp_directory):
+            shutil.rmtree(temp_directory, ignore_errors=True)
+    return ColumnStore(shp_filename, meta, directory=directory,
+                       arrays=dict(arrays))
+
+
+def write_column_store(shp_filename):
+    """Write the column store of shp_filename to disk and return it."""
+    return _save(shp_filename, *_read_columns(shp_filename))
+
+
+def _read_meta(shp_filename):
+    """Return meta of the valid column store of shp_filename, or None."""
+    meta_filename = os.path.join(
+        column_store_directory(shp_filename), META_FILENAME)
+    try:
+        with open(meta_filename) as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if (meta.get('version') != VERSION or
+        meta.get('mtime') != os.path.getmtime(shp_filename)):
+        logger.info("Ignoring stale column store of %s.", shp_filename)
+        return None
+    return meta
+
+
+def column_store(shp_filename):
+    """Return the ColumnStore of shp_filename, building it if needed.
+
+    If the store can't be written next to the shapefile, it is kept in
+    memory. Raises OSError or IOError if the shapefile can't be read.
+    """
+    mtime = os.path.getmtime(shp_filename)
+    with _stores_lock:
+        cached = _stores.get(shp_filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    meta = _read_meta(shp_filename)
+    if meta is not None:
+        store = ColumnStore(
+            shp_filename, meta,
+            directory=column_store_directory(shp_filename))
+    else:
+        meta, arrays = _read_columns(shp_filename)
+        try:
+            store = _save(shp_filename, meta, arrays)
+        except (IOError, OSError):
+            logger.exception("Could not write column store of %s, "
+                             "keeping it in memory.", shp_filename)
+            store = ColumnStore(shp_filename, meta, arrays=arrays)
+    with _stores_lock:
+        _stores[shp_filename] = (mtime, store)
+    return store
@@ -0,0 +1,46 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Per process pool of open mapnik Shapefile datasources.
+
+Opening a datasource reads the shapefile headers and the index, so
+they are kept open and shared between renders. The pool is keyed by
+filename, mtime of the shapefile and mtime of its mapnik index, and
+holds at most LIZARD_SHAPE_MAX_DATASOURCES (default: 64) datasources,
+least recently used ones are closed first.
+"""
+import os
+
+from django.conf import settings
+import mapnik
+
+from lizard_shape.indexes import LRUCache
+from lizard_shape.spatialindex import mapnik_index_filename
+from lizard_shape.spatialindex import remove_stale_indexes
+
+MAX_DATASOURCES = getattr(settings, 'LIZARD_SHAPE_MAX_DATASOURCES', 64)
+
+_datasources = LRUCache(MAX_DATASOURCES)
+
+
+def _index_mtime(shp_filename):
+    try:
+        return os.path.getmtime(mapnik_index_filename(shp_filename))
+    except OSError:
+        return None
+
+
+def shapefile_datasource(shp_filename):
+    """Return a mapnik.Shapefile datasource of shp_filename from the
+    pool, opening it if needed. Stale indexes are removed first."""
+    remove_stale_indexes(shp_filename)
+    key = (shp_filename, os.path.getmtime(shp_filename),
+           _index_mtime(shp_filename))
+    datasource = _datasources.get(key)
+    if datasource is None:
+        datasource = mapnik.Shapefile(file=shp_filename)
+        _datasources.set(key, datasource)
+    return datasource
+
+
+def clear_datasources():
+    _datasources.clear()
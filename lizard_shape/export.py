@@ -0,0 +1,236 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Streaming export of the features of a Shape as GeoJSON or CSV.
+
+Features are read from the shapefile and reprojected in chunks, so the
+whole layer is never in memory. Only the columns of the ShapeFields of
+the shape's template are exported.
+"""
+import csv
+import json
+import logging
+import numbers
+
+from shapely.geometry import mapping
+from shapely.geometry import shape as as_shape
+from shapely.wkb import loads
+import osgeo.ogr
+
+from lizard_map.coordinates import google_projection
+from lizard_map.coordinates import wgs84_projection
+from lizard_shape.columns import INTEGER_TYPES
+from lizard_shape.indexes import id_index
+from lizard_shape.indexes import ignore_fields
+from lizard_shape.indexes import shapefile_schema
+from lizard_shape.projections import shape_projection
+from lizard_shape.spatialindex import remove_stale_indexes
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 500
+PROJECTIONS = {
+    'wgs84': wgs84_projection,
+    'google': google_projection}
+
+
+class ExportError(Exception):
+    pass
+
+
+def _positions(coords):
+    """Yield all (x, y) positions of GeoJSON coordinates."""
+    if coords and isinstance(coords[0], numbers.Number):
+        yield coords
+    else:
+        for part in coords:
+            for position in _positions(part):
+                yield position
+
+
+def _replace_positions(coords, positions):
+    """Return coords with positions taken from iterator positions."""
+    if coords and isinstance(coords[0], numbers.Number):
+        return next(positions)
+    return [_replace_positions(part, positions) for part in coords]
+
+
+def _reproject(geometries, projection, target):
+    """Reproject a chunk of GeoJSON geometry dicts in one pyproj call."""
+    positions = []
+    for geometry in geometries:
+        positions.extend(_positions(geometry['coordinates']))
+    transformed = iter(projection.to_many(positions, target))
+    return [{'type': geometry['type'],
+             'coordinates': _replace_positions(
+                    geometry['coordinates'], transformed)}
+            for geometry in geometries]
+
+
+def _typed_value(lyr, field_index, value):
+    """Convert value (i.e. from a GET parameter) to the type of field
+    field_index. Raises ExportError if that fails."""
+    field_type = lyr.GetLayerDefn().GetFieldDefn(field_index).GetType()
+    try:
+        if field_type in INTEGER_TYPES:
+            return int(value)
+        if field_type == osgeo.ogr.OFTReal:
+            return float(value)
+    except ValueError:
+        raise ExportError("Invalid value %r" % value)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return value
+
+
+def _sql_literal(value):
+    """Return value as literal for an OGR SQL attribute filter."""
+    if isinstance(value, numbers.Number):
+        return repr(value)
+    return u"'%s'" % value.replace(u"'", u"''")
+
+
+def feature_chunks(shape, bbox=None, ids=None, attribute=None,
+                   value=None, srs='wgs84'):
+    """Return an iterator over chunks of (properties, geometry) of the
+    features of shape.
+
+    * bbox -- (minx, miny, maxx, maxy) in srs
+
+    * ids -- only features with these values of the template's id_field
+
+    * attribute, value -- only features where column attribute equals
+      value
+
+    * srs -- 'wgs84' or 'google', projection of bbox and of the result
+
+    properties are dicts with the template's ShapeField columns,
+    geometries are GeoJSON dicts in srs. Raises ExportError for invalid
+    arguments before anything is read.
+    """
+    if srs not in PROJECTIONS:
+        raise ExportError("Unknown srs %s" % srs)
+    target = PROJECTIONS[srs]
+    filename = shape.shp_file.path
+    projection = shape_projection(shape.prj)
+    fields = [shape_field.field for shape_field in
+              shape.template.shapefield_set.all()]
+
+    remove_stale_indexes(filename)
+    ds = osgeo.ogr.Open(filename)
+    if ds is None:
+        raise ExportError("Could not open shapefile of %s" % shape)
+    lyr = ds.GetLayer()
+    schema = shapefile_schema(filename, lyr)
+    field_indexes = [(field, schema.get(field)) for field in fields
+                     if field in schema]
+
+    fids = None
+    if ids is not None:
+        id_field = shape.template.id_field
+        if not id_field or id_field not in schema:
+            raise ExportError("Shape %s has no valid id field" % shape)
+        ids = [_typed_value(lyr, schema.get(id_field), identifier)
+               for identifier in ids]
+        ids_to_fids = id_index(filename, id_field, lyr, schema)
+        fids = sorted(set(fid for identifier in ids
+                          for fid in ids_to_fids.get(identifier, [])))
+
+    ignore_fields(lyr, schema, [field for field, _ in field_indexes])
+    if attribute is not None:
+        if attribute not in fields or attribute not in schema:
+            raise ExportError("Attribute %s can't be filtered" % attribute)
+        attribute_index = schema.get(attribute)
+        value = _typed_value(lyr, attribute_index, value)
+        lyr.SetAttributeFilter((u'"%s" = %s' % (
+                    schema.field_names[attribute_index],
+                    _sql_literal(value))).encode('utf-8'))
+    if bbox is not None:
+        corners = [projection.from_projection(target, x, y)
+                   for x in (bbox[0], bbox[2]) for y in (bbox[1], bbox[3])]
+        lyr.SetSpatialFilterRect(
+            min(x for x, _ in corners), min(y for _, y in corners),
+            max(x for x, _ in corners), max(y for _, y in corners))
+
+    if fids is not None:
+        # Filters are not applied by GetFeature, check them here.
+        def features():
+            for fid in fids:
+                feat = lyr.GetFeature(fid)
+                geom = feat.GetGeometryRef()
+                if bbox is not None and not (
+                    geom and geom.Intersects(lyr.GetSpatialFilter())):
+                    continue
+                if (attribute is not None and
+                    feat.GetField(attribute_index) != value):
+                    continue
+                yield feat
+    else:
+        def features():
+            lyr.ResetReading()
+            feat = lyr.GetNextFeature()
+            while feat is not None:
+                yield feat
+                feat = lyr.GetNextFeature()
+
+    return _chunks(ds, features(), field_indexes, projection, target)
+
+
+def _chunks(ds, features, field_indexes, projection, target):
+    """Yield lists of (properties, geometry) of features of ds."""
+    properties, geometries = [], []
+    for feat in features:
+        geom = feat.GetGeometryRef()
+        if not geom:
+            continue
+        properties.append(dict((field, feat.GetField(field_index))
+                               for field, field_index in field_indexes))
+        geometries.append(mapping(loads(bytes(geom.ExportToWkb()))))
+        if len(geometries) == CHUNK_SIZE:
+            yield list(zip(properties,
+                           _reproject(geometries, projection, target)))
+            properties, geometries = [], []
+    if geometries:
+        yield list(zip(properties,
+                       _reproject(geometries, projection, target)))
+
+
+def iter_geojson(chunks):
+    """Yield a GeoJSON FeatureCollection in pieces."""
+    yield '{"type": "FeatureCollection", "features": ['
+    first = True
+    for chunk in chunks:
+        features = ',\n'.join(
+            json.dumps({'type': 'Feature',
+                        'properties': properties,
+                        'geometry': geometry})
+            for properties, geometry in chunk)
+        if features:
+            yield features if first else ',\n' + features
+            first = False
+    yield ']}\n'
+
+
+class _Echo(object):
+    """File-like object that returns what is written, for csv.writer."""
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bytes):
+        return value
+    return (u'%s' % value).encode('utf-8')
+
+
+def iter_csv(chunks, fields):
+    """Yield CSV rows of fields plus the geometry as WKT, in chunks."""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(list(fields) + ['wkt'])
+    for chunk in chunks:
+        yield ''.join(
+            writer.writerow(
+                [_csv_value(properties.get(field)) for field in fields] +
+                [as_shape(geometry).wkt])
+            for properties, geometry in chunk)
@@ -0,0 +1,341 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+In-process indexes on shapefiles.
+
+Indexes are built once per shapefile and kept for as long as the file
+on disk does not change: the mtime of the .shp file is part of the
+key, so re-uploading a shape automatically invalidates its index.
+"""
+from collections import OrderedDict
+import logging
+import os
+import threading
+
+from django.conf import settings
+from shapely.geometry import box
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
+from shapely.wkb import loads
+import numpy
+import osgeo.ogr
+
+from lizard_shape.sidecar import id_key
+from lizard_shape.sidecar import id_kind
+from lizard_shape.sidecar import read_bbox_sidecar
+from lizard_shape.sidecar import read_id_sidecar
+
+logger = logging.getLogger(__name__)
+
+# Memory budget of the decoded geometry cache, measured in WKB bytes.
+GEOMETRY_CACHE_BYTES = getattr(
+    settings, 'LIZARD_SHAPE_GEOMETRY_CACHE_BYTES', 64 * 1024 * 1024)
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class LRUCache(object):
+    """
+    Thread safe least recently used cache with a size budget.
+
+    Every item is stored with a size. When the total size exceeds
+    max_size, the least recently used items are dropped.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = (value, size)
+            return value
+
+    def set(self, key, value, size=1):
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, dropped_size) = self._items.popitem(last=False)
+                self.size -= dropped_size
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._items)
+
+
+_geometries = LRUCache(GEOMETRY_CACHE_BYTES)
+_schemas = {}
+_schemas_lock = threading.Lock()
+_id_indexes = {}
+_id_indexes_lock = threading.Lock()
+
+
+class ShapefileSchema(object):
+    """
+    Field names of a shapefile, mapped to their OGR field indexes.
+
+    Column names in dbf files sometimes end with spaces, so both the
+    original and the stripped names are available.
+    """
+    def __init__(self, layer_defn):
+        self.field_names = []
+        self.field_indexes = {}
+        for field_index in range(layer_defn.GetFieldCount()):
+            name = layer_defn.GetFieldDefn(field_index).GetName()
+            self.field_names.append(name)
+            self.field_indexes[name] = field_index
+        for field_index, name in enumerate(self.field_names):
+            self.field_indexes.setdefault(name.strip(), field_index)
+
+    def __contains__(self, name):
+        return name in self.field_indexes
+
+    def get(self, name, default=None):
+        """Return the field index of name."""
+        return self.field_indexes.get(name, default)
+
+
+class IdIndex(object):
+    """
+    In-process id index: dict of id key to list of FIDs.
+
+    Ids are looked up with the same rule as in id sidecars, see
+    lizard_shape.sidecar.id_key.
+    """
+    def __init__(self, kind):
+        self.kind = kind
+        self.fids = {}
+
+    def add(self, value, fid):
+        key = id_key(value, self.kind)
+        if key is not None:
+            self.fids.setdefault(key, []).append(fid)
+
+    def get(self, value, default=None):
+        """Return the list of FIDs of id value, or default."""
+        key = id_key(value, self.kind)
+        if key is None:
+            return default
+        return self.fids.get(key, default)
+
+    def __len__(self):
+        return len(self.fids)
+
+
+class ShapefileIndex(object):
+    """
+    STRtree on the bounding boxes of all features of a shapefile.
+
+    Only the envelopes and FIDs are kept in memory. Candidates found
+    in the tree are read back from the shapefile by FID. The envelopes
+    are read from the bbox sidecar file if it is valid.
+    """
+    def __init__(self, filename, mtime):
+        self.filename = filename
+        self.mtime = mtime
+        self._boxes = []
+        self._position_by_box = {}
+        self._tree = None
+
+        table = read_bbox_sidecar(filename)
+        if table is not None:
+            self.fids = table['fid'].tolist()
+            bounds = numpy.column_stack(
+                [table['minx'], table['miny'], table['maxx'], table['maxy']])
+        else:
+            self.fids, bounds = self._read_bounds(filename)
+        self._bounds = numpy.array(bounds, dtype=float).reshape(-1, 4)
+        for position, (minx, miny, maxx, maxy) in enumerate(
+            self._bounds.tolist()):
+            envelope = box(minx, miny, maxx, maxy)
+            self._position_by_box[id(envelope)] = position
+            self._boxes.append(envelope)
+        if self._boxes:
+            self._tree = STRtree(self._boxes)
+        logger.debug("Built spatial index for %s (%d features).",
+                     filename, len(self.fids))
+
+    def _read_bounds(self, filename):
+        """Return FIDs and bounds of features by scanning the file."""
+        ds = osgeo.ogr.Open(filename)
+        if ds is None:
+            raise IOError("Could not open shapefile %s" % filename)
+        lyr = ds.GetLayer()
+        ignore_fields(lyr, ShapefileSchema(lyr.GetLayerDefn()), [])
+        fids, bounds = [], []
+        lyr.ResetReading()
+        feat = lyr.GetNextFeature()
+        while feat is not None:
+            geom = feat.GetGeometryRef()
+            if geom:
+                minx, maxx, miny, maxy = geom.GetEnvelope()
+                fids.append(feat.GetFID())
+                bounds.append((minx, miny, maxx, maxy))
+            feat = lyr.GetNextFeature()
+        return fids, bounds
+
+    def _query_positions(self, minx, miny, maxx, maxy):
+        if self._tree is None:
+            return []
+        result = []
+        for hit in self._tree.query(box(minx, miny, maxx, maxy)):
+            if isinstance(hit, BaseGeometry):
+                # Shapely 1.x returns the geometries themselves.
+                result.append(self._position_by_box[id(hit)])
+            else:
+                # Shapely 2.x returns positions in the input list.
+                result.append(int(hit))
+        return result
+
+    def query(self, minx, miny, maxx, maxy):
+        """Return FIDs of features whose envelope intersects the
+        given rectangle."""
+        return [self.fids[position] for position in
+                self._query_positions(minx, miny, maxx, maxy)]
+
+    def candidates(self, x, y, radius=None):
+        """Return (envelope distance, fid) of features that can be
+        within radius of (x, y), nearest envelope first.
+
+        The envelope distance is a lower bound for the distance to
+        the feature itself. Without radius, all features are returned.
+        """
+        if radius is not None:
+            positions = numpy.array(self._query_positions(
+                    x - radius, y - radius, x + radius, y + radius),
+                                    dtype=int)
+        else:
+            positions = numpy.arange(len(self.fids))
+        bounds = self._bounds[positions]
+        dx = numpy.maximum(
+            numpy.maximum(bounds[:, 0] - x, x - bounds[:, 2]), 0)
+        dy = numpy.maximum(
+            numpy.maximum(bounds[:, 1] - y, y - bounds[:, 3]), 0)
+        distances = numpy.hypot(dx, dy)
+        if radius is not None:
+            inside = distances < radius
+            positions, distances = positions[inside], distances[inside]
+        order = numpy.argsort(distances, kind='mergesort')
+        return [(distances[i], self.fids[positions[i]]) for i in order]
+
+
+def ignore_fields(lyr, schema, needed, geometry=True):
+    """Let OGR skip reading the columns of lyr that are not needed.
+
+    needed contains (possibly stripped) field names, unknown names are
+    skipped. If geometry is False, geometries are not read either.
+    """
+    keep = set()
+    for name in needed:
+        field_index = schema.get(name)
+        if field_index is not None:
+            keep.add(field_index)
+    ignored = [name for field_index, name in enumerate(schema.field_names)
+               if field_index not in keep]
+    ignored.append('OGR_STYLE')
+    if not geometry:
+        ignored.append('OGR_GEOMETRY')
+    lyr.SetIgnoredFields(ignored)
+
+
+def shapefile_index(filename):
+    """Return an up to date ShapefileIndex for filename.
+
+    Raises OSError if the file does not exist.
+    """
+    mtime = os.path.getmtime(filename)
+    with _indexes_lock:
+        index = _indexes.get(filename)
+        if index is not None and index.mtime == mtime:
+            return index
+    # Build outside of the lock: this can take a while for big files.
+    index = ShapefileIndex(filename, mtime)
+    with _indexes_lock:
+        _indexes[filename] = index
+    return index
+
+
+def feature_geometry(index, lyr, fid):
+    """Return the shapely geometry of feature fid, or None.
+
+    Geometries are decoded from WKB and cached per (file, mtime, fid),
+    so repeated searches in the same area do not touch the shapefile.
+    lyr is an opened OGR layer of index.filename.
+    """
+    key = (index.filename, index.mtime, fid)
+    item = _geometries.get(key)
+    if item is None:
+        geom = lyr.GetFeature(fid).GetGeometryRef()
+        if not geom:
+            return None
+        wkb = bytes(geom.ExportToWkb())
+        item = loads(wkb)
+        _geometries.set(key, item, size=len(wkb))
+    return item
+
+
+def shapefile_schema(filename, lyr):
+    """Return the (cached) ShapefileSchema of filename.
+
+    lyr is an opened OGR layer of filename, used when the schema is not
+    cached yet or when the file changed.
+    """
+    mtime = os.path.getmtime(filename)
+    with _schemas_lock:
+        cached = _schemas.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    schema = ShapefileSchema(lyr.GetLayerDefn())
+    with _schemas_lock:
+        _schemas[filename] = (mtime, schema)
+    return schema
+
+
+def id_index(filename, field_name, lyr, schema):
+    """Return an index of value of field_name to list of FIDs, with a
+    dict like get().
+
+    A valid id sidecar file is used if available. Otherwise the index
+    is built on first use by reading only the id column of lyr, and is
+    cached per (filename, field_name) for as long as the file does not
+    change.
+    """
+    mtime = os.path.getmtime(filename)
+    key = (filename, field_name)
+    with _id_indexes_lock:
+        cached = _id_indexes.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    index = read_id_sidecar(filename, field_name)
+    if index is not None:
+        # No need to cache: the sidecar is cached by lizard_shape.sidecar.
+        return index
+    field_index = schema.get(field_name)
+    index = IdIndex(id_kind(
+            lyr.GetLayerDefn().GetFieldDefn(field_index).GetType()))
+    ignore_fields(lyr, schema, [field_name], geometry=False)
+    lyr.ResetReading()
+    feat = lyr.GetNextFeature()
+    while feat is not None:
+        index.add(feat.GetField(field_index), feat.GetFID())
+        feat = lyr.GetNextFeature()
+    lyr.SetIgnoredFields([])
+    logger.debug("Built id index on %s of %s (%d ids).",
+                 field_name, filename, len(index))
+    with _id_indexes_lock:
+        _id_indexes[key] = (mtime, index)
+    return index
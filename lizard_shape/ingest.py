@@ -0,0 +1,45 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Derived files for uploaded shapes, written next to the shapefile.
+
+prepare_shape() is called when a Shape is saved and by the
+lizard_shape_prepare management command.
+
+Set LIZARD_SHAPE_GOOGLE_COPIES to False to skip writing copies of the
+shapefiles in google (see lizard_shape.reprojected) and their simplified
+levels (see lizard_shape.pyramid).
+"""
+import logging
+
+from django.conf import settings
+
+from lizard_shape.columns import write_column_store
+from lizard_shape.pyramid import write_pyramid
+from lizard_shape.reprojected import google_copy_filename
+from lizard_shape.reprojected import write_google_copy
+from lizard_shape.sidecar import write_bbox_sidecar
+from lizard_shape.sidecar import write_id_sidecar
+from lizard_shape.spatialindex import write_spatial_indexes
+
+logger = logging.getLogger(__name__)
+
+
+def prepare_shape(shape):
+    """Write all derived files of shape. Errors are logged, not raised:
+    the adapter falls back to reading the shapefile itself."""
+    try:
+        shp_filename = shape.shp_file.path
+        write_spatial_indexes(shp_filename)
+        write_bbox_sidecar(shp_filename)
+        if shape.template.id_field:
+            write_id_sidecar(shp_filename, shape.template.id_field)
+        write_column_store(shp_filename)
+        if getattr(settings, 'LIZARD_SHAPE_GOOGLE_COPIES', True):
+            write_google_copy(shp_filename, shape.prj)
+            write_spatial_indexes(google_copy_filename(shp_filename))
+            for level_filename in write_pyramid(shp_filename):
+                write_spatial_indexes(level_filename)
+    except (IOError, OSError, KeyError, ValueError, RuntimeError):
+        # ValueError: no file (yet), RuntimeError: GDAL errors.
+        logger.exception("Could not write derived files for shape %s.",
+                         shape)
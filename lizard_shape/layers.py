@@ -1,9 +1,8 @@
+import heapq
 import json
+import math
 
-from pyproj import Proj
-from pyproj import transform
 from shapely.geometry import Point
-from shapely.wkt import loads
 import datetime
 import logging
 import mapnik
@@ -14,16 +13,34 @@ from django.core.urlresolvers import reverse
 from django.template.loader import render_to_string
 
 from lizard_map.adapter import Graph
-from lizard_map.coordinates import detect_prj
-from lizard_map.coordinates import google_projection
+from lizard_map.coordinates import GOOGLE
 from lizard_map.models import WorkspaceItemError
 from lizard_map.utility import float_to_string
 from lizard_map.workspace import WorkspaceItemAdapter
+from lizard_shape.caching import cached_style
+from lizard_shape.caching import get_popup
+from lizard_shape.caching import get_search_results
+from lizard_shape.caching import popup_cache_key
+from lizard_shape.caching import search_cache_key
+from lizard_shape.caching import set_popup
+from lizard_shape.caching import set_search_results
+from lizard_shape.columns import column_store
+from lizard_shape.datasources import shapefile_datasource
+from lizard_shape.indexes import feature_geometry
+from lizard_shape.indexes import id_index
+from lizard_shape.indexes import ignore_fields
+from lizard_shape.indexes import shapefile_index
+from lizard_shape.indexes import shapefile_schema
 from lizard_shape.models import Shape
 from lizard_shape.models import ShapeField
 from lizard_shape.models import ShapeLegend
 from lizard_shape.models import ShapeLegendClass
 from lizard_shape.models import ShapeLegendPoint
+from lizard_shape.projections import attach_google_coords
+from lizard_shape.projections import shape_projection
+from lizard_shape.pyramid import pyramid_levels
+from lizard_shape.reprojected import google_copy
+from lizard_shape.reprojected import is_google_request
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +48,87 @@ MAX_SEARCH_RESULTS = 3
 LEGEND_TYPE_SHAPELEGEND = 'ShapeLegend'
 LEGEND_TYPE_SHAPELEGENDCLASS = 'ShapeLegendClass'
 LEGEND_TYPE_SHAPELEGENDPOINT = 'ShapeLegendPoint'
+LEGEND_MODELS = {
+    LEGEND_TYPE_SHAPELEGEND: ShapeLegend,
+    LEGEND_TYPE_SHAPELEGENDPOINT: ShapeLegendPoint,
+    LEGEND_TYPE_SHAPELEGENDCLASS: ShapeLegendClass}
+
+
+def native_search_area(projection, x, y, radius=None):
+    """Transform google x, y and radius to the given ShapeProjection.
+
+    Returns (x, y, radius), radius is None if no radius is given.
+    """
+    transformed_x, transformed_y = projection.from_google(x, y)
+    if radius is None:
+        return transformed_x, transformed_y, None
+
+    # Manually make radius smaller
+
+    # RG, way later: it used to say 0.2 on the line below, but
+    # there were complaints saying that this was too
+    # small. From some manual testing, 1 (the default) is too
+    # large. I'll put 0.8. Obviously a very well argued value.
+    logger.debug("Adjusting radius...")
+    radius = radius * 0.8
+
+    # The radius needs to be transformed as well, but how?
+    # A transformed square will no longer be a square!
+    # This needs further attention...
+
+    transformed_x_radius, transformed_y_radius = (
+        projection.from_google(x + radius, y + radius))
+
+    radius = max(abs(transformed_x - transformed_x_radius),
+                 abs(transformed_y - transformed_y_radius))
+    return transformed_x, transformed_y, radius
+
+
+def google_scale(projection, x, y, offset=100.0):
+    """Return the number of google units per unit of the given
+    ShapeProjection around google x, y."""
+    native_x, native_y = projection.from_google(x, y)
+    native_distances = [
+        math.hypot(other_x - native_x, other_y - native_y)
+        for other_x, other_y in (projection.from_google(x + offset, y),
+                                 projection.from_google(x, y + offset))]
+    return offset * 2 / sum(native_distances)
+
+
+def search_many(adapters, x, y, radius=None,
+                max_results=MAX_SEARCH_RESULTS):
+    """Search multiple shapefile layers at once, i.e. for a map click.
+
+    adapters is a list of AdapterShapefile instances or of their
+    layer_arguments dicts. x, y and radius are in google coordinates,
+    like in AdapterShapefile.search. Layers are grouped by projection,
+    so the search point is transformed only once per projection.
+
+    Returns the merged results of all layers (max_results per layer),
+    sorted by distance. Layers can have different units, so the
+    distances of the results are converted to google units.
+    """
+    by_prj = {}
+    for adapter in adapters:
+        if isinstance(adapter, dict):
+            adapter = AdapterShapefile(None, layer_arguments=adapter)
+        if not adapter.search_property_name or max_results < 1:
+            continue
+        by_prj.setdefault(adapter.prj, []).append(adapter)
+
+    results = []
+    for prj, prj_adapters in by_prj.items():
+        projection = shape_projection(prj)
+        transformed_x, transformed_y, native_radius = native_search_area(
+            projection, x, y, radius)
+        scale = google_scale(projection, x, y)
+        for adapter in prj_adapters:
+            for result in adapter._search_native(
+                transformed_x, transformed_y, native_radius, max_results):
+                result['distance'] *= scale
+                results.append(result)
+    results.sort(key=lambda result: result['distance'])
+    return results
 
 
 class AdapterShapefile(WorkspaceItemAdapter):
@@ -141,6 +239,10 @@ class AdapterShapefile(WorkspaceItemAdapter):
         self.legend_type = layer_arguments.get('legend_type', None)
         self.value_field = layer_arguments.get('value_field', None)
         self.value_name = layer_arguments.get('value_name', None)
+        # Legends drawn on top of the legend, with the same
+        # datasource. List of dicts with keys legend_type, legend_id,
+        # value_field.
+        self.extra_legends = layer_arguments.get('extra_legends', [])
         self.display_fields = layer_arguments.get('display_fields', [])
         if not self.display_fields:
             self.display_fields = [
@@ -148,6 +250,26 @@ class AdapterShapefile(WorkspaceItemAdapter):
                  'field': self.value_field,
                  'field_type': ShapeField.FIELD_TYPE_NORMAL}]
 
+    @property
+    def projection(self):
+        """ShapeProjection of this shapefile, shared within the process."""
+        return shape_projection(self.prj)
+
+    def _render_sources(self, google=False):
+        """Return [(shapefile, srs, min scale, max scale)] for mapnik.
+
+        If google is requested and there is an up to date copy of the
+        shapefile in google, that copy and its simplified levels are
+        rendered, each in its own scale range. Otherwise the shapefile
+        itself is rendered at all scales (None).
+        """
+        if google:
+            levels = pyramid_levels(self.layer_filename)
+            if levels:
+                return [(filename, GOOGLE, min_scale, max_scale)
+                        for min_scale, max_scale, filename in levels]
+        return [(self.layer_filename, self.projection.srs, None, None)]
+
     def _default_mapnik_style(self):
         """
         Makes default mapnik style
@@ -165,29 +287,68 @@ class AdapterShapefile(WorkspaceItemAdapter):
 
     @property
     def _legend_object(self):
-        legend_models = {
-            LEGEND_TYPE_SHAPELEGEND: ShapeLegend,
-            LEGEND_TYPE_SHAPELEGENDPOINT: ShapeLegendPoint,
-            LEGEND_TYPE_SHAPELEGENDCLASS: ShapeLegendClass}
-        legend_model = legend_models[self.legend_type]
+        legend_model = LEGEND_MODELS[self.legend_type]
 
         legend_object = None
         if self.legend_id is not None:
             legend_object = legend_model.objects.get(pk=self.legend_id)
         return legend_object
 
+    def _mapnik_styles(self):
+        """Return [(style name, mapnik style)] of the legend and the
+        extra legends, in drawing order."""
+        if self.legend_id is None:
+            # Show layer with default legend.
+            return [(str('Area style %s' % self.layer_filename),
+                     self._default_mapnik_style())]
+
+        legends = [(self.legend_type, self.legend_id, self.value_field)]
+        legends.extend((extra['legend_type'], extra['legend_id'],
+                        extra['value_field'])
+                       for extra in self.extra_legends)
+        result = []
+        for legend_type, legend_id, value_field in legends:
+            # Cached, so tiles don't need the database.
+            style = cached_style(
+                legend_type, legend_id, value_field,
+                lambda: LEGEND_MODELS[legend_type].objects.get(
+                    pk=legend_id).mapnik_style(value_field=str(value_field)))
+            style_name = str('Area style %s::%s::%s::%s' % (
+                    self.layer_filename,
+                    legend_type,
+                    legend_id,
+                    value_field))
+            result.append((style_name, style))
+        return result
+
     def legend(self, updates=None):
-        if (self.legend_type == LEGEND_TYPE_SHAPELEGEND or
-            self.legend_type == LEGEND_TYPE_SHAPELEGENDPOINT):
-            return super(AdapterShapefile, self).legend_default(
-                self._legend_object)
+        """Return the legend rows of the legend, followed by those of
+        the extra legends."""
+        legend_result = self._legend_rows(self.legend_type,
+                                          self._legend_object)
+        for extra in self.extra_legends:
+            legend_model = LEGEND_MODELS[extra['legend_type']]
+            try:
+                legend = legend_model.objects.get(pk=extra['legend_id'])
+            except legend_model.DoesNotExist:
+                logger.warning("Extra legend %s %s does not exist.",
+                               extra['legend_type'], extra['legend_id'])
+                continue
+            legend_result.extend(
+                self._legend_rows(extra['legend_type'], legend))
+        return legend_result
+
+    def _legend_rows(self, legend_type, legend):
+        """Return the legend rows of legend object legend."""
+        if (legend_type == LEGEND_TYPE_SHAPELEGEND or
+            legend_type == LEGEND_TYPE_SHAPELEGENDPOINT):
+            return list(super(AdapterShapefile, self).legend_default(legend))
 
         # LEGEND_TYPE_SHAPELEGENDCLASS
         icon_style_template = {'icon': 'empty.png',
                                'mask': ('empty_mask.png',),
                                'color': (1, 1, 1, 1)}
         legend_result = []
-        legend = self._legend_object
 
         if legend is not None:
             for single_class in legend.shapelegendsingleclass_set.all():
@@ -215,9 +376,12 @@ class AdapterShapefile(WorkspaceItemAdapter):
                 legend_result.append(legend_row)
         return legend_result
 
-    def layer(self, layer_ids=None, request=None):
+    def layer(self, layer_ids=None, request=None, google=None):
         """Return layer and styles for a shapefile.
 
+        google tells if the map is in google. If it is None, it is taken
+        from the SRS of the (WMS) request.
+
         http://127.0.0.1:8000/map/workspace/1/wms/?LAYERS=basic&SERVICE=
         WMS&VERSION=1.1.1&REQUEST=GetMap&STYLES=&EXCEPTIONS=application%
         2Fvnd.ogc.se_inimage&FORMAT=image%2Fjpeg&SRS=EPSG%3A900913&BBOX=
@@ -226,49 +390,48 @@ class AdapterShapefile(WorkspaceItemAdapter):
         """
         layers = []
         styles = {}
-        layer = mapnik.Layer(self.layer_name, detect_prj(self.prj))
-        # TODO: ^^^ translation!
-        logging.debug("Giving shapefile %s to a mapnik layer...",
-                      self.layer_filename)
-        layer.datasource = mapnik.Shapefile(
-            file=self.layer_filename)
-
-        if self.legend_id is not None:
-            legend = self._legend_object
-            style = legend.mapnik_style(
-                value_field=str(self.value_field))
-        else:
-            # Show layer with default legend.
-            style = self._default_mapnik_style()
-
-        style_name = str('Area style %s::%s::%s' % (
-                self.layer_filename,
-                self.legend_id,
-                self.value_field))
-        styles[style_name] = style
-        layer.styles.append(style_name)
-        layers = [layer]
+        if google is None:
+            google = is_google_request(request)
+
+        mapnik_styles = self._mapnik_styles()
+        styles.update(mapnik_styles)
+
+        for filename, srs, min_scale, max_scale in self._render_sources(
+            google):
+            layer = mapnik.Layer(self.layer_name, srs)
+            # TODO: ^^^ translation!
+            logging.debug("Giving shapefile %s to a mapnik layer...",
+                          filename)
+            layer.datasource = shapefile_datasource(filename)
+            # Scale denominators, the layer is drawn from minzoom up to
+            # maxzoom.
+            if min_scale is not None:
+                layer.minzoom = min_scale
+            if max_scale is not None:
+                layer.maxzoom = max_scale
+            for style_name, _ in mapnik_styles:
+                layer.styles.append(style_name)
+            if len(mapnik_styles) > 1:
+                # Query the datasource once for all styles.
+                layer.cache_features = True
+            layers.append(layer)
         logging.debug("Giving shapefile %s as layer to mapnik...",
                       self.layer_filename)
         return layers, styles
 
     def extent(self, identifiers=None):
-        """Calculate extent using ogr GetExtent function
+        """Calculate extent using the envelope of the (pooled) mapnik
+        datasource. The google copy of the shapefile is used if
+        available.
         """
-        layer = mapnik.Layer(self.layer_name, detect_prj(self.prj))
+        copy_filename = google_copy(self.layer_filename)
+        envelope = shapefile_datasource(
+            copy_filename or self.layer_filename).envelope()
+        w, s, e, n = envelope.minx, envelope.miny, envelope.maxx, envelope.maxy
 
-        layer.datasource = mapnik.Shapefile(
-            file=self.layer_filename)
-
-        ds = osgeo.ogr.Open(self.layer_filename)
-        lyr = ds.GetLayer()
-        lyr.ResetReading()
-        w, e, s, n = lyr.GetExtent()
-
-        w, s = transform(
-            Proj(detect_prj(self.prj)), google_projection, w, s)
-        e, n = transform(
-            Proj(detect_prj(self.prj)), google_projection, e, n)
+        if copy_filename is None:
+            w, s = self.projection.to_google(w, s)
+            e, n = self.projection.to_google(e, n)
 
         return {
             'north': n,
@@ -276,7 +439,7 @@ class AdapterShapefile(WorkspaceItemAdapter):
             'south': s,
             'east': e}
 
-    def search(self, x, y, radius=None):
+    def search(self, x, y, radius=None, max_results=MAX_SEARCH_RESULTS):
         """
         Search area, line or point.
 
@@ -289,26 +452,40 @@ class AdapterShapefile(WorkspaceItemAdapter):
         the search does not work for lines and points. So the
         implementation was done with shapely.
 
+        Candidate features are taken from an in-memory spatial index
+        on the shapefile, see lizard_shape.indexes. Only the
+        max_results nearest features are returned. Results are cached
+        for nearby points, see lizard_shape.caching.
+
         """
         logger.debug("Searching coordinates (%0.2f, %0.2f) radius %r..." %
                      (x, y, radius))
 
-        if not self.search_property_name:
+        if not self.search_property_name or max_results < 1:
             # We don't have anything to return, so don't search.
             return []
 
-        if radius is not None:
-            # Manually make radius smaller
-
-            # RG, way later: it used to say 0.2 on the line below, but
-            # there were complaints saying that this was too
-            # small. From some manual testing, 1 (the default) is too
-            # large. I'll put 0.8. Obviously a very well argued value.
-            logger.debug("Adjusting radius...")
-            radius = radius * 0.8
-
-        transformed_x, transformed_y = transform(
-            google_projection, Proj(detect_prj(self.prj)), x, y)
+        cache_key = search_cache_key(self, x, y, radius, max_results)
+        if cache_key is not None:
+            results = get_search_results(cache_key, self.workspace_item)
+            if results is not None:
+                return results
+
+        transformed_x, transformed_y, radius = native_search_area(
+            self.projection, x, y, radius)
+        results = self._search_native(
+            transformed_x, transformed_y, radius, max_results)
+        if cache_key is not None:
+            set_search_results(cache_key, results)
+        return results
+
+    def _search_native(self, transformed_x, transformed_y, radius,
+                       max_results):
+        """Search around a point in the projection of the shapefile.
+
+        See search(), radius is in native units as well.
+        """
+        projection = self.projection
         query_point = Point(transformed_x, transformed_y)
 
         ds = osgeo.ogr.Open(self.layer_filename)
@@ -321,108 +498,112 @@ class AdapterShapefile(WorkspaceItemAdapter):
                          "to a missing shapefile.")
             return []
 
-        if radius is not None:
-
-            # The radius needs to be transformed as well, but how?
-            # A transformed square will no longer be a square!
-            # This needs further attention...
-
-            transformed_x_radius, transformed_y_radius = transform(
-                google_projection, Proj(detect_prj(self.prj)),
-                x + radius, y + radius)
-
-            radius = max(abs(transformed_x - transformed_x_radius),
-                         abs(transformed_y - transformed_y_radius))
-
-            lyr.SetSpatialFilterRect(
-                transformed_x - radius,
-                transformed_y - radius,
-                transformed_x + radius,
-                transformed_y + radius)
-
-        lyr.ResetReading()
-        feat = lyr.GetNextFeature()
+        try:
+            index = shapefile_index(self.layer_filename)
+        except (OSError, IOError):
+            logger.exception("Could not build spatial index for %s.",
+                             self.layer_filename)
+            return []
 
+        # Check the fields once, instead of for every feature.
+        schema = shapefile_schema(self.layer_filename, lyr)
+        name_index = schema.get(self.search_property_name)
+        if name_index is None:
+            # This means that the search_property_name is not a
+            # valid field in the shapefile dbf.
+            logger.error(
+                ('Search: The field "%s" cannot be found in '
+                 'shapefile "%s". Available fields: %r'
+                 'Check your settings in '
+                 'lizard_shape.models.Shape.') %
+                (self.search_property_name, self.layer_name,
+                 schema.field_names))
+            return []
+        display_index = None
+        if self.display_fields:
+            display_index = schema.get(self.display_fields[0]['field'])
+            if display_index is None:
+                # This means that the value_field is not a
+                # valid field in the shapefile dbf.
+                logger.error(
+                    ('Search: The field "%s" cannot be found in '
+                     'shapefile "%s". Check display_fields. '
+                     'Options are: %s') %
+                    (self.display_fields[0]['field'],
+                     self.layer_name,
+                     schema.field_names))
+                return []
+        id_field_index = None
+        if self.search_property_id:
+            id_field_index = schema.get(self.search_property_id)
+        if id_field_index is None:
+            logger.error("Problem with search_property_id: %s. "
+                         "List of available properties: %r" %
+                         (self.search_property_id,
+                          schema.field_names))
+
+        # Keep the max_results nearest features in a heap of
+        # (-distance, -fid, geometry): the worst one is on top. Only
+        # geometries are needed for that, no attributes.
+        ignore_fields(lyr, schema, [])
+        nearest = []
+        candidates = index.candidates(transformed_x, transformed_y, radius)
+        for envelope_distance, fid in candidates:
+            if (len(nearest) == max_results and
+                envelope_distance > -nearest[0][0]):
+                # Candidates are sorted by envelope distance, which is a
+                # lower bound for the real distance: we're done.
+                break
+            item = feature_geometry(index, lyr, fid)
+            if item is None:
+                continue
+            distance = query_point.distance(item)
+            if radius and distance >= radius:
+                continue
+            if len(nearest) < max_results:
+                heapq.heappush(nearest, (-distance, -fid, item))
+            elif distance < -nearest[0][0]:
+                heapq.heapreplace(nearest, (-distance, -fid, item))
+        if len(candidates) > max_results:
+            logger.debug('A lot of candidates found (%d), just taking '
+                         'top %s.', len(candidates), max_results)
+
+        # Only build result dicts for the winners.
+        store = column_store(self.layer_filename)
         results = []
-
-        while feat is not None:
-            geom = feat.GetGeometryRef()
-            if geom:
-                item = loads(geom.ExportToWkt())
-                distance = query_point.distance(item)
-                feat_items = feat.items()
-
-                if not radius or (radius is not None and distance < radius):
-                    # Add stripped keys, because column names can contain
-                    # spaces after the 'real' name.
-                    for key in feat_items.keys():
-                        feat_items[key.strip()] = feat_items[key]
-
-                    # Found an item.
-                    if self.search_property_name not in feat_items:
-                        # This means that the search_property_name is not a
-                        # valid field in the shapefile dbf.
-                        logger.error(
-                            ('Search: The field "%s" cannot be found in '
-                             'shapefile "%s". Available fields: %r'
-                             'Check your settings in '
-                             'lizard_shape.models.Shape.') %
-                            (self.search_property_name, self.layer_name,
-                             feat_items.keys()))
-                        break  # You don't have to search other rows.
-                    name = str(feat_items[self.search_property_name])
-
-                    if self.display_fields:
-                        if self.display_fields[0]['field'] not in feat_items:
-                            # This means that the value_field is not a
-                            # valid field in the shapefile dbf.
-                            logger.error(
-                                ('Search: The field "%s" cannot be found in '
-                                 'shapefile "%s". Check display_fields. '
-                                 'Options are: %s') %
-                                (self.display_fields[0]['field'],
-                                 self.layer_name,
-                                 feat_items.keys()))
-                            break  # You don't have to search other rows.
-                        name += ' - %s=%s' % (
-                            self.display_fields[0]['name'],
-                            str(float_to_string(feat_items[
-                                        self.display_fields[0]['field']])))
-
-                    result = {'distance': distance,
-                              'name': name,
-                              'workspace_item': self.workspace_item}
-                    try:
-                        result.update(
-                            {'google_coords':
-                                 transform(Proj(detect_prj(self.prj)),
-                                           google_projection,
-                                           *item.coords[0])})
-                    except NotImplementedError:
-                        logger.warning(
-                            "Got a NotImplementedError while transforming "
-                            "coordinates from %s to google with pyproj "
-                            "for shapefile %s. Not returning google "
-                            "coordinates.",
-                            self.prj, self.shape)
-
-                    if (self.search_property_id and
-                        self.search_property_id in feat_items):
-                        result.update(
-                            {'identifier':
-                                 {'id': feat_items[self.search_property_id]}})
-                    else:
-                        logger.error("Problem with search_property_id: %s. "
-                                     "List of available properties: %r" %
-                                     (self.search_property_id,
-                                      feat_items.keys()))
-                    results.append(result)
-            feat = lyr.GetNextFeature()
-        results = sorted(results, key=lambda a: a['distance'])
-        if len(results) > MAX_SEARCH_RESULTS:
-            logger.info('A lot of results found (%d), just taking top %s.',
-                        len(results), MAX_SEARCH_RESULTS)
-        return results[:MAX_SEARCH_RESULTS]
+        coords = []
+        for neg_distance, neg_fid, item in sorted(nearest, reverse=True):
+            distance, fid = -neg_distance, -neg_fid
+            name = str(store.value(self.search_property_name, fid))
+            if display_index is not None:
+                name += ' - %s=%s' % (
+                    self.display_fields[0]['name'],
+                    str(float_to_string(store.value(
+                                self.display_fields[0]['field'], fid))))
+
+            result = {'distance': distance,
+                      'name': name,
+                      'workspace_item': self.workspace_item}
+            # Coordinates are transformed to google in one batch
+            # for all results, see below.
+            result_coords = None
+            try:
+                result_coords = item.coords[0]
+            except NotImplementedError:
+                logger.warning(
+                    "Got a NotImplementedError while getting "
+                    "coordinates (projection %s) "
+                    "for shapefile %s. Not returning google "
+                    "coordinates.",
+                    self.prj, self.shape)
+
+            if id_field_index is not None:
+                result.update(
+                    {'identifier':
+                         {'id': store.value(self.search_property_id, fid)}})
+            results.append(result)
+            coords.append(result_coords)
+        return attach_google_coords(results, coords, projection)
 
     def symbol_url(self, identifier=None, start_date=None,
                    end_date=None, icon_style=None):
@@ -452,80 +633,17 @@ class AdapterShapefile(WorkspaceItemAdapter):
         Optional: force_list forces the output in list format
         """
 
-        ds = osgeo.ogr.Open(self.layer_filename)
-        lyr = ds.GetLayer()
-        lyr.ResetReading()
-        feat = lyr.GetNextFeature()
-
-        item, google_x, google_y, feat_items = None, None, None, None
         id_list = []
         if id is not None:
-            id_list.append(id)
+            id_list.append({'id': id})
         if ids is not None:
-            id_list.extend([identifier['id'] for identifier in ids])
+            id_list.extend(ids)
         if len(id_list) == 0:
             logger.warning('No id given in call to location. '
                            'Should never happen.')
             return {}
 
-        logger.debug("Location(s): %r" % id_list)
-        logger.debug("Fields to display: %r" % self.display_fields)
-
-        result = []
-
-        # Find one features.
-        while feat is not None:
-            geom = feat.GetGeometryRef()
-            feat_items = feat.items()
-            # Add stripped keys. Sometimes columnnames contain spaces
-            # at the end.
-            for key in feat_items.keys():
-                feat_items[key.strip()] = feat_items[key]
-            if self.search_property_id not in feat_items:
-                logger.error("Search property id '%s' not available. "
-                             "Options are: %r" % (self.search_property_id,
-                                                  feat_items.keys()))
-            if (geom and
-                self.search_property_id in feat_items and
-                id_list.count(feat_items[self.search_property_id]) > 0):
-
-                # item = loads(geom.ExportToWkt())
-
-                # Polygons get an error when getting coords. Coords
-                # are not needed any more, so leave them out.
-
-                # google_x, google_y = coordinates.rd_to_google(
-                #     *item.coords[0])
-
-                # contains {'name': <name>, 'value': <value>,
-                # 'value_type: 1/2/3'}
-                values = []
-
-                for field in self.display_fields:
-                    if str(field['field']) not in feat_items:
-                        # Trying to show a field that's not in feat_items
-                        values.append({'name': field['name'],
-                                       'value': 'Not present in data',
-                                       'value_type': 1})
-                    else:
-                        values.append({'name': field['name'],
-                                       'value':
-                                           feat_items[str(field['field'])],
-                                       'value_type': field['field_type']})
-
-                name = feat_items[self.search_property_name]
-                result.append({
-                        'name': name,
-                        'shortname': name,
-                        'value_name': self.value_name,
-                        'value': feat_items[self.value_field],
-                        'values': values,
-                        'object': feat_items,
-                        'workspace_item': self.workspace_item,
-                        'identifier': {'id': feat_items[
-                                self.search_property_id]}})
-
-            feat = lyr.GetNextFeature()
+        result = list(self.iter_location(id_list, file_order=True))
 
         logger.debug("%d result(s) found" % len(result))
 
@@ -534,9 +652,91 @@ class AdapterShapefile(WorkspaceItemAdapter):
         else:
             return result
 
+    def iter_location(self, ids, file_order=False):
+        """Yield the location dicts of identifiers ids one by one.
+
+        Streaming variant of location(), for large sets of identifiers
+        (i.e. exports, see StreamingHttpResponse). Results are yielded
+        in the order of ids, or in the order of the shapefile if
+        file_order is True. Features are yielded once, even if their
+        id is given multiple times.
+        """
+        ds = osgeo.ogr.Open(self.layer_filename)
+        lyr = ds.GetLayer()
+
+        id_list = [identifier['id'] for identifier in ids]
+        logger.debug("Location(s): %r" % id_list)
+        logger.debug("Fields to display: %r" % self.display_fields)
+
+        # Check the fields once, instead of for every feature.
+        schema = shapefile_schema(self.layer_filename, lyr)
+        if self.search_property_id not in schema:
+            logger.error("Search property id '%s' not available. "
+                         "Options are: %r" % (self.search_property_id,
+                                              schema.field_names))
+            return
+
+        # Find the features by id, without scanning the shapefile.
+        ids_to_fids = id_index(self.layer_filename, self.search_property_id,
+                               lyr, schema)
+        fids = []
+        seen = set()
+        for identifier in id_list:
+            for fid in ids_to_fids.get(identifier, []):
+                if fid not in seen:
+                    seen.add(fid)
+                    fids.append(fid)
+        if file_order:
+            fids.sort()
+
+        # Read the attributes of the features that were found.
+        store = column_store(self.layer_filename)
+        for fid in fids:
+            if store.has_geometry(fid):
+                yield self._location_result(store.record(fid))
+
+    def _location_result(self, feat_items):
+        """Return the location dict of a FeatureRecord."""
+
+        # item = loads(geom.ExportToWkt())
+
+        # Polygons get an error when getting coords. Coords
+        # are not needed any more, so leave them out.
+
+        # google_x, google_y = coordinates.rd_to_google(
+        #     *item.coords[0])
+
+        # contains {'name': <name>, 'value': <value>,
+        # 'value_type: 1/2/3'}
+        values = []
+
+        for field in self.display_fields:
+            if str(field['field']) not in feat_items:
+                # Trying to show a field that's not in feat_items
+                values.append({'name': field['name'],
+                               'value': 'Not present in data',
+                               'value_type': 1})
+            else:
+                values.append({'name': field['name'],
+                               'value': feat_items[str(field['field'])],
+                               'value_type': field['field_type']})
+
+        name = feat_items[self.search_property_name]
+        return {
+            'name': name,
+            'shortname': name,
+            'value_name': self.value_name,
+            'value': feat_items[self.value_field],
+            'values': values,
+            'object': feat_items,
+            'workspace_item': self.workspace_item,
+            'identifier': {'id': feat_items[self.search_property_id]}}
+
     def html(self, snippet_group=None, identifiers=None, layout_options=None):
         """
         Renders table with shape attributes.
+
+        Rendered popups are cached, see lizard_shape.caching.
         """
 
         logger.debug("Generating html popup...")
@@ -545,11 +745,19 @@ class AdapterShapefile(WorkspaceItemAdapter):
             snippets = snippet_group.snippets.all()
             identifiers = [snippet.identifier for snippet in snippets]
 
-        display_group = self.location(None, identifiers, force_list=True)
         add_snippet = False
         if layout_options and 'add_snippet' in layout_options:
             add_snippet = layout_options['add_snippet']
 
+        cache_key = popup_cache_key(self, identifiers, add_snippet)
+        if cache_key is not None:
+            popup = get_popup(cache_key)
+            if popup is not None:
+                return popup
+
+        display_group = self.iter_location(identifiers or [],
+                                           file_order=True)
+
         # Images for timeseries
 
         image_graph_url = None
@@ -574,7 +782,7 @@ class AdapterShapefile(WorkspaceItemAdapter):
                     # self.bin = input.read()
                     pass
 
-        return render_to_string(
+        popup = render_to_string(
             'lizard_shape/popup_shape.html',
             {'display_group': display_group,
              'add_snippet': add_snippet,
@@ -583,6 +791,9 @@ class AdapterShapefile(WorkspaceItemAdapter):
              'adapter_class': self.adapter_class,
              'adapter_layer_json': json.dumps(self.layer_arguments),
              'his_file_dtstart': his_file_dtstart})
+        if cache_key is not None:
+            set_popup(cache_key, popup)
+        return popup
 
     def image(self, identifiers, start_date, end_date,
               width=380.0, height=250.0, layout_extra=None):
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from lizard_shape.ingest import prepare_shape
+from lizard_shape.models import Shape
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('(Re)builds the derived files (spatial and sidecar indexes, '
+            'column stores, google copies) of all Shape models.')
+
+    def handle(self, *args, **options):
+        for s in Shape.objects.all():
+            self.stdout.write('Preparing shape %s...' % s)
+            prepare_shape(s)
@@ -4,11 +4,18 @@ import logging
 
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils.translation import ugettext as _
 from lizard_map.mapnik_helper import point_rule
 from lizard_map.fields import ColorField
 from lizard_map.models import Legend
 from lizard_map.models import LegendPoint
+from lizard_shape.caching import invalidate_legend
+from lizard_shape.caching import invalidate_popups
+from lizard_shape.ingest import prepare_shape
+from lizard_shape.rules import class_rules
 #from nens.sobek import HISFile
 from treebeard.al_tree import AL_Node
 import mapnik
@@ -346,66 +353,50 @@ class ShapeLegendClass(models.Model):
     def mapnik_style(self, value_field=None):
         """
         Generates mapnik style from this object.
+
+        The classes are compiled to ordered rules (see
+        lizard_shape.rules) and mapnik draws each feature with the
+        first rule that matches, or the default class.
         """
         if value_field is None:
             value_field = 'value'
         style = mapnik.Style()
-        classes = self.shapelegendsingleclass_set.all()
-
-        # Add a rule for each class
-        for c in classes:
-            layout_rule = mapnik.Rule()
-            if c.color_inside:
-                area_looks = mapnik.PolygonSymbolizer(
-                    mapnik.Color('#' + c.color_inside))
-                area_looks.fill_opacity = 0.5
-                layout_rule.symbols.append(area_looks)
-                logger.debug('adding polygon symbolizer')
-            if c.color:
-                line_looks = mapnik.LineSymbolizer(
-                    mapnik.Color('#' + c.color), c.size)
-                layout_rule.symbols.append(line_looks)
-                logger.debug('adding line symbolizer')
-            mapnik_filter = None
-            if c.is_exact or c.min_value and c.min_value == c.max_value:
-                # Check if c.min_value is parsable as float. Yes:
-                # compare like float.
-                try:
-                    float(c.min_value)
-                    mapnik_filter = str("[%s] = %s" % (
-                            value_field, c.min_value))
-                except ValueError:
-                    mapnik_filter = str("[%s] = '%s'" % (
-                            value_field, c.min_value))
-            else:
-                if c.min_value and c.max_value:
-                    mapnik_filter = str("[%s] >= %s and [%s] < %s"
-                                        % (value_field,
-                                           c.min_value,
-                                           value_field,
-                                           c.max_value))
-                elif c.min_value and not c.max_value:
-                    mapnik_filter = str("[%s] >= %s"
-                                        % (value_field,
-                                           c.min_value))
-                elif not c.min_value and c.max_value:
-                    mapnik_filter = str("[%s] < %s"
-                                        % (value_field,
-                                           c.max_value))
-            if mapnik_filter is not None:
-                logger.debug('adding mapnik_filter: %s' % mapnik_filter)
-                layout_rule.filter = mapnik.Filter(mapnik_filter)
-
+        style.filter_mode = mapnik.filter_mode.FIRST
+        rules, default = class_rules(
+            self.shapelegendsingleclass_set.all(), value_field)
+
+        for mapnik_filter, c in rules:
+            style.rules.append(self._class_rule(c, mapnik_filter))
+        if default is not None:
+            layout_rule = self._class_rule(default, None)
+            layout_rule.set_else(True)
             style.rules.append(layout_rule)
-
-            # Add icon rule, if applicable.
-            if c.icon:
-                style.rules.append(
-                    point_rule(c.icon, c.mask,
-                               c.color, mapnik_filter))
-
         return style
 
+    def _class_rule(self, c, mapnik_filter):
+        """Rule with the symbolizers of single class c."""
+        layout_rule = mapnik.Rule()
+        if c.color_inside:
+            area_looks = mapnik.PolygonSymbolizer(
+                mapnik.Color('#' + c.color_inside))
+            area_looks.fill_opacity = 0.5
+            layout_rule.symbols.append(area_looks)
+            logger.debug('adding polygon symbolizer')
+        if c.color:
+            line_looks = mapnik.LineSymbolizer(
+                mapnik.Color('#' + c.color), c.size)
+            layout_rule.symbols.append(line_looks)
+            logger.debug('adding line symbolizer')
+        # Add icon, if applicable. In the same rule, as only the first
+        # matching rule is drawn.
+        if c.icon:
+            for symbol in point_rule(c.icon, c.mask, c.color, None).symbols:
+                layout_rule.symbols.append(symbol)
+        if mapnik_filter is not None:
+            logger.debug('adding mapnik_filter: %s' % mapnik_filter)
+            layout_rule.filter = mapnik.Filter(mapnik_filter)
+        return layout_rule
+
     def icon_style(self):
         icon = 'polygon.png'
         color = (1.0, 1.0, 1.0, 1.0)
@@ -506,3 +497,42 @@ class His(models.Model):
     def hisfile(self):
         result = HISFile(self.filename.path)
         return result
+
+
+@receiver(post_save, sender=Shape)
+def shape_post_save(sender, instance, **kwargs):
+    """Write sidecar files for the uploaded shapefile."""
+    if kwargs.get('raw'):
+        # Loading fixtures: related objects may not be there yet.
+        return
+    prepare_shape(instance)
+
+
+@receiver(post_save, sender=Shape)
+@receiver(post_delete, sender=Shape)
+@receiver(post_save, sender=ShapeTemplate)
+@receiver(post_delete, sender=ShapeTemplate)
+@receiver(post_save, sender=ShapeField)
+@receiver(post_delete, sender=ShapeField)
+def invalidate_popups_receiver(sender, **kwargs):
+    """Popups show shape, template and field settings."""
+    invalidate_popups()
+
+
+@receiver(post_save, sender=ShapeLegend)
+@receiver(post_delete, sender=ShapeLegend)
+@receiver(post_save, sender=ShapeLegendPoint)
+@receiver(post_delete, sender=ShapeLegendPoint)
+@receiver(post_save, sender=ShapeLegendClass)
+@receiver(post_delete, sender=ShapeLegendClass)
+def invalidate_legend_receiver(sender, instance, **kwargs):
+    """Rebuild the mapnik styles of a changed legend."""
+    invalidate_legend(sender.__name__, instance.pk)
+
+
+@receiver(post_save, sender=ShapeLegendSingleClass)
+@receiver(post_delete, sender=ShapeLegendSingleClass)
+def invalidate_single_class_receiver(sender, instance, **kwargs):
+    """Rebuild the mapnik styles of the legend of a changed class."""
+    invalidate_legend(ShapeLegendClass.__name__,
+                      instance.shape_legend_class_id)
@@ -0,0 +1,119 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Process wide registry of shapefile projections.
+
+Parsing a .prj file and initializing pyproj is expensive compared to
+transforming a coordinate, so every distinct .prj text is handled only
+once per process.
+"""
+from functools import partial
+import threading
+
+from pyproj import Proj
+import numpy
+
+try:
+    from pyproj import Transformer
+except ImportError:
+    # pyproj 1.x: no ready made transformers.
+    from pyproj import transform
+    Transformer = None
+
+from lizard_map.coordinates import detect_prj
+from lizard_map.coordinates import google_projection
+
+_projections = {}
+_projections_lock = threading.Lock()
+
+
+class ShapeProjection(object):
+    """
+    Projection of a shapefile, ready to transform from and to google.
+
+    * srs -- projection string as returned by detect_prj, usable by mapnik
+
+    * proj -- pyproj Proj instance for srs
+
+    Transformers are made once per thread and pair of projections (with
+    pyproj >= 2, pyproj.transform makes a new one for every call).
+    """
+    def __init__(self, prj):
+        self.prj = prj
+        self.srs = detect_prj(prj)
+        self.proj = Proj(self.srs)
+        self._local = threading.local()
+
+    def _transformer(self, source, target):
+        """Return a function transforming x, y from Proj source to Proj
+        target."""
+        transformers = getattr(self._local, 'transformers', None)
+        if transformers is None:
+            transformers = self._local.transformers = {}
+        key = (source.srs, target.srs)
+        transformer = transformers.get(key)
+        if transformer is None:
+            if Transformer is not None:
+                transformer = Transformer.from_proj(
+                    source, target, always_xy=True).transform
+            else:
+                transformer = partial(transform, source, target)
+            transformers[key] = transformer
+        return transformer
+
+    def to_google(self, x, y):
+        """Transform x, y from the shapefile projection to google."""
+        return self._transformer(self.proj, google_projection)(x, y)
+
+    def from_google(self, x, y):
+        """Transform google x, y to the shapefile projection."""
+        return self._transformer(google_projection, self.proj)(x, y)
+
+    def from_projection(self, projection, x, y):
+        """Transform x, y from pyproj Proj projection to the shapefile
+        projection."""
+        return self._transformer(projection, self.proj)(x, y)
+
+    def to_many(self, coords, projection):
+        """Transform a sequence of (x, y) to pyproj Proj projection in
+        one pyproj call.
+
+        Returns a list of (x, y) tuples in the same order.
+        """
+        if not coords:
+            return []
+        xs = numpy.fromiter((c[0] for c in coords), dtype=float,
+                            count=len(coords))
+        ys = numpy.fromiter((c[1] for c in coords), dtype=float,
+                            count=len(coords))
+        new_xs, new_ys = self._transformer(self.proj, projection)(xs, ys)
+        return list(zip(new_xs.tolist(), new_ys.tolist()))
+
+    def to_google_many(self, coords):
+        """Transform a sequence of (x, y) to google in one pyproj call."""
+        return self.to_many(coords, google_projection)
+
+
+def shape_projection(prj):
+    """Return the (cached) ShapeProjection for the given .prj text."""
+    try:
+        return _projections[prj]
+    except KeyError:
+        pass
+    projection = ShapeProjection(prj)
+    with _projections_lock:
+        return _projections.setdefault(prj, projection)
+
+
+def attach_google_coords(results, coords, projection):
+    """Fill 'google_coords' of each result dict in one batch.
+
+    coords contains an (x, y) in the shapefile projection for each
+    result, or None if the result has no coordinates.
+    """
+    todo = [(result, coord) for result, coord in zip(results, coords)
+            if coord is not None]
+    google_coords = projection.to_google_many(
+        [coord for _, coord in todo])
+    for (result, _), google_coord in zip(todo, google_coords):
+        result['google_coords'] = google_coord
+    return results
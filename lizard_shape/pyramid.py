@@ -0,0 +1,89 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Simplified copies of the google copy of a shapefile, for rendering at
+small scales.
+
+For every scale denominator in LIZARD_SHAPE_PYRAMID_SCALES (default:
+100000, 1000000 and 10000000) a copy <base>.900913.s<scale>.shp is
+written, simplified with a tolerance of half a pixel at that scale. The
+copy is rendered from that scale up to the next one, the google copy
+itself below the smallest scale. Point shapefiles are not simplified.
+"""
+import logging
+import os
+
+import osgeo.ogr
+
+from django.conf import settings
+
+from lizard_shape.reprojected import copy_shapefile
+from lizard_shape.reprojected import google_copy
+from lizard_shape.reprojected import google_copy_filename
+from lizard_shape.reprojected import google_srs
+
+logger = logging.getLogger(__name__)
+
+PYRAMID_SCALES = sorted(getattr(
+        settings, 'LIZARD_SHAPE_PYRAMID_SCALES', (100000, 1000000, 10000000)))
+# Size of a pixel in meters at scale denominator 1 (OGC: 0.28mm).
+PIXEL_SIZE = 0.00028
+POINT_TYPES = (osgeo.ogr.wkbPoint, osgeo.ogr.wkbMultiPoint,
+               osgeo.ogr.wkbPoint25D, osgeo.ogr.wkbMultiPoint25D)
+
+
+def level_filename(shp_filename, scale):
+    return '%s.s%d.shp' % (
+        os.path.splitext(google_copy_filename(shp_filename))[0], scale)
+
+
+def pyramid_levels(shp_filename):
+    """Return [(min scale, max scale, filename)] to render shp_filename in
+    google, starting with the google copy.
+
+    The last level has max scale None. Levels that are missing or older
+    than the google copy end the list. Returns [] if there is no up to
+    date google copy.
+    """
+    copy_filename = google_copy(shp_filename)
+    if copy_filename is None:
+        return []
+    copy_mtime = os.path.getmtime(copy_filename)
+    levels = []
+    min_scale, filename = None, copy_filename
+    for scale in PYRAMID_SCALES:
+        simplified_filename = level_filename(shp_filename, scale)
+        try:
+            if os.path.getmtime(simplified_filename) < copy_mtime:
+                break
+        except OSError:
+            break
+        levels.append((min_scale, scale, filename))
+        min_scale, filename = scale, simplified_filename
+    levels.append((min_scale, None, filename))
+    return levels
+
+
+def write_pyramid(shp_filename):
+    """Write the simplified levels of the google copy of shp_filename.
+
+    Returns the filenames of the levels, [] for point shapefiles.
+    """
+    copy_filename = google_copy(shp_filename)
+    if copy_filename is None:
+        raise IOError("No up to date google copy of %s" % shp_filename)
+    ds = osgeo.ogr.Open(copy_filename)
+    geom_type = ds.GetLayer().GetGeomType()
+    ds = None
+    if geom_type in POINT_TYPES:
+        return []
+
+    srs = google_srs()
+    filenames = []
+    for scale in PYRAMID_SCALES:
+        tolerance = scale * PIXEL_SIZE / 2
+        filename = level_filename(shp_filename, scale)
+        copy_shapefile(
+            copy_filename, filename, srs,
+            lambda geom: geom.SimplifyPreserveTopology(tolerance) or geom)
+        filenames.append(filename)
+    return filenames
@@ -0,0 +1,113 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Copies of shapefiles reprojected to google (the map projection).
+
+Rendering a copy in the map projection saves mapnik from reprojecting
+every vertex of every tile. The original shapefile stays the source for
+attribute queries in native coordinates.
+"""
+import logging
+import os
+
+from osgeo import osr
+import osgeo.ogr
+
+from lizard_map.coordinates import GOOGLE
+from lizard_shape.projections import shape_projection
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_SRS_NAMES = ('EPSG:900913', 'EPSG:3857', 'EPSG:102100')
+
+
+def google_copy_filename(shp_filename):
+    return os.path.splitext(shp_filename)[0] + '.900913.shp'
+
+
+def is_google_request(request):
+    """Return True if the SRS (or CRS) of a WMS request is google."""
+    if request is None:
+        return False
+    requested_srs = request.GET.get('SRS', request.GET.get('CRS', ''))
+    return requested_srs.upper() in GOOGLE_SRS_NAMES
+
+
+def google_copy(shp_filename):
+    """Return the filename of the google copy of shp_filename, or None
+    if there is no copy that is newer than the shapefile."""
+    copy_filename = google_copy_filename(shp_filename)
+    try:
+        if os.path.getmtime(copy_filename) >= os.path.getmtime(shp_filename):
+            return copy_filename
+    except OSError:
+        pass
+    return None
+
+
+def copy_shapefile(shp_filename, copy_filename, srs, transform):
+    """Write a copy of shp_filename, with all attributes, to
+    copy_filename.
+
+    srs is the osr.SpatialReference of the copy. transform(geom) is
+    called on the (OGR) geometry of every feature and returns the
+    geometry to write. FIDs are kept.
+    """
+    source = osgeo.ogr.Open(shp_filename)
+    if source is None:
+        raise IOError("Could not open shapefile %s" % shp_filename)
+    source_lyr = source.GetLayer()
+
+    driver = osgeo.ogr.GetDriverByName('ESRI Shapefile')
+    if os.path.exists(copy_filename):
+        driver.DeleteDataSource(copy_filename)
+    target = driver.CreateDataSource(copy_filename)
+    layer_defn = source_lyr.GetLayerDefn()
+    target_lyr = target.CreateLayer(
+        str(os.path.splitext(os.path.basename(copy_filename))[0]),
+        srs, layer_defn.GetGeomType())
+    for i in range(layer_defn.GetFieldCount()):
+        target_lyr.CreateField(layer_defn.GetFieldDefn(i))
+
+    source_lyr.ResetReading()
+    feat = source_lyr.GetNextFeature()
+    while feat is not None:
+        copy = osgeo.ogr.Feature(target_lyr.GetLayerDefn())
+        copy.SetFrom(feat)
+        geom = copy.GetGeometryRef()
+        if geom:
+            copy.SetGeometry(transform(geom))
+        # FIDs are kept: features are written in the same order.
+        target_lyr.CreateFeature(copy)
+        feat = source_lyr.GetNextFeature()
+    target = None  # Flushes the copy.
+    logger.info("Wrote %s.", copy_filename)
+
+
+def google_srs():
+    """Return google as osr.SpatialReference."""
+    srs = osr.SpatialReference()
+    srs.ImportFromProj4(GOOGLE)
+    return srs
+
+
+def google_transformation(prj):
+    """Return an osr.CoordinateTransformation from the projection of a
+    shapefile (the contents of its .prj file) to google."""
+    source_srs = osr.SpatialReference()
+    source_srs.ImportFromProj4(str(shape_projection(prj).srs))
+    return osr.CoordinateTransformation(source_srs, google_srs())
+
+
+def write_google_copy(shp_filename, prj):
+    """Write a copy of shp_filename, with all attributes, in google.
+
+    prj is the contents of the .prj file of the shapefile.
+    """
+    transformation = google_transformation(prj)
+
+    def transform(geom):
+        geom.Transform(transformation)
+        return geom
+
+    copy_shapefile(shp_filename, google_copy_filename(shp_filename),
+                   google_srs(), transform)
@@ -0,0 +1,103 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Compilation of the classes of a ShapeLegendClass to mapnik filters.
+
+The rules are meant for a style with first-match filter mode: exact
+values first, then the numeric ranges sorted on their lower bound, then
+ranges with bounds that are no numbers. A range that overlaps earlier
+ranges is cut to what they don't cover. The lower bound of a range is
+not checked if the earlier range rules imply it, unless the range has
+no upper bound: then the rule would have no check at all. Contiguous
+ranges need one comparison each. The first class without bounds is the
+default, for the else rule.
+"""
+INFINITY = float('inf')
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _format(value):
+    return '%.15g' % value
+
+
+def exact_filter(value_field, value):
+    """Filter on value_field equal to value, as number if possible."""
+    if _float(value) is not None:
+        return str("[%s] = %s" % (value_field, value))
+    return str("[%s] = '%s'" % (value_field, value))
+
+
+def range_filter(value_field, min_value, max_value):
+    """Filter on min_value <= value_field < max_value, both bounds are
+    optional."""
+    checks = []
+    if min_value is not None:
+        checks.append("[%s] >= %s" % (value_field, min_value))
+    if max_value is not None:
+        checks.append("[%s] < %s" % (value_field, max_value))
+    return str(' and '.join(checks))
+
+
+def is_exact(single_class):
+    return bool(single_class.is_exact or
+                single_class.min_value and
+                single_class.min_value == single_class.max_value)
+
+
+def class_rules(classes, value_field):
+    """Return (rules, default) for ShapeLegendSingleClasses classes.
+
+    rules is a list of (filter, class) in evaluation order, every rule
+    has a filter. default is the class for the else rule, or None.
+    """
+    exact_rules, ranges, other_rules = [], [], []
+    default = None
+    for single_class in classes:
+        min_value = single_class.min_value or None
+        max_value = single_class.max_value or None
+        if is_exact(single_class):
+            exact_rules.append(
+                (exact_filter(value_field, min_value), single_class))
+        elif min_value is None and max_value is None:
+            if default is None:
+                default = single_class
+        else:
+            lower = -INFINITY if min_value is None else _float(min_value)
+            upper = INFINITY if max_value is None else _float(max_value)
+            if lower is None or upper is None:
+                other_rules.append(
+                    (range_filter(value_field, min_value, max_value),
+                     single_class))
+            else:
+                ranges.append((lower, upper, single_class))
+
+    range_rules = []
+    # Values below covered are matched by earlier range rules, values
+    # below reach may be.
+    covered = reach = -INFINITY
+    # Stable sort: ranges with the same lower bound keep their order.
+    ranges.sort(key=lambda item: item[0])
+    for lower, upper, single_class in ranges:
+        lower = max(lower, reach)
+        if upper <= lower:
+            # Completely covered by earlier ranges.
+            continue
+        if lower <= covered and upper != INFINITY:
+            check_lower = None
+            covered = upper
+        else:
+            # Without an upper bound the lower bound is always checked:
+            # a rule without checks would also match empty values and
+            # values that are no numbers, instead of the else rule.
+            check_lower = _format(lower)
+        check_upper = None if upper == INFINITY else _format(upper)
+        reach = max(reach, upper)
+        range_rules.append(
+            (range_filter(value_field, check_lower, check_upper),
+             single_class))
+    return exact_rules + range_rules + other_rules, default
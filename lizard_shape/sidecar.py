@@ -0,0 +1,261 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Sidecar index files, stored next to a shapefile.
+
+Two kinds of files are written:
+
+* <base>.bbox.lzi -- packed table of (fid, minx, miny, maxx, maxy) of
+  all features with a geometry.
+
+* <base>.id-<field>.lzi -- sorted table of id keys, with their FIDs.
+  Keys are integers or reals for numeric id fields and bytes for
+  others, see id_key. Empty ids are left out.
+
+Each file starts with a header containing a version number and the
+mtime of the .shp file. Files with another version or mtime are
+ignored. Tables are opened with numpy.memmap, so all worker processes
+share them through the page cache.
+"""
+import logging
+import os
+import struct
+import threading
+
+import numpy
+import osgeo.ogr
+
+from lizard_shape.columns import INTEGER_TYPES
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'LZSI'
+VERSION = 2
+# magic, version, mtime of the .shp file, number of rows, key width, key
+# kind, padded to 32 bytes so the tables are aligned.
+HEADER = struct.Struct('<4sIdQIc3x')
+BBOX_DTYPE = numpy.dtype([
+        ('fid', '<i8'),
+        ('minx', '<f8'),
+        ('miny', '<f8'),
+        ('maxx', '<f8'),
+        ('maxy', '<f8')])
+FID_DTYPE = numpy.dtype('<i8')
+
+_opened = {}
+_opened_lock = threading.Lock()
+
+
+def bbox_sidecar_filename(shp_filename):
+    return os.path.splitext(shp_filename)[0] + '.bbox.lzi'
+
+
+def id_sidecar_filename(shp_filename, field_name):
+    return os.path.splitext(shp_filename)[0] + '.id-%s.lzi' % (
+        field_name.strip())
+
+
+def id_kind(field_type):
+    """Return the kind of id keys of an OGR field type: b'i' (integer),
+    b'f' (real) or b'S' (bytes)."""
+    if field_type in INTEGER_TYPES:
+        return b'i'
+    if field_type == osgeo.ogr.OFTReal:
+        return b'f'
+    return b'S'
+
+
+def id_key(value, kind):
+    """Return id value as key of kind, or None if it can't be an id.
+
+    The id sidecars and the in-process id indexes (see
+    lizard_shape.indexes.id_index) both use it, so i.e. 3, '3' and 3.0
+    find the same features of a numeric id field.
+    """
+    if value is None:
+        return None
+    if kind == b'S':
+        if isinstance(value, bytes):
+            return value
+        return (u'%s' % value).encode('utf-8')
+    try:
+        if kind == b'f':
+            return float(value)
+        if isinstance(value, float):
+            return int(value) if value.is_integer() else None
+        try:
+            return int(value)
+        except ValueError:
+            # I.e. '3.0'.
+            number = float(value)
+            return int(number) if number.is_integer() else None
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _key_dtype(kind, width):
+    if kind == b'i':
+        return numpy.dtype('<i8')
+    if kind == b'f':
+        return numpy.dtype('<f8')
+    return numpy.dtype('S%d' % width)
+
+
+def _write(filename, shp_filename, count, width, arrays, kind=b'-'):
+    """Write header and arrays to filename, replacing it atomically."""
+    mtime = os.path.getmtime(shp_filename)
+    # Per process, others may write the same sidecar.
+    temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(temp_filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, mtime, count, width, kind))
+        for array in arrays:
+            array.tofile(f)
+    os.rename(temp_filename, filename)
+    logger.info("Wrote sidecar %s (%d rows).", filename, count)
+
+
+def _read_header(filename, shp_filename):
+    """Return (count, width, kind) if filename is a valid sidecar, else
+    None."""
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(HEADER.size)
+        mtime = os.path.getmtime(shp_filename)
+    except (IOError, OSError):
+        return None
+    if len(header) < HEADER.size:
+        return None
+    magic, version, sidecar_mtime, count, width, kind = HEADER.unpack(
+        header)
+    if magic != MAGIC or version != VERSION:
+        logger.info("Ignoring sidecar %s with another version.", filename)
+        return None
+    if sidecar_mtime != mtime:
+        logger.info("Ignoring stale sidecar %s.", filename)
+        return None
+    return count, width, kind
+
+
+def _memmap(filename, dtype, offset, count):
+    if count == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode='r',
+                        offset=offset, shape=(count, ))
+
+
+def write_bbox_sidecar(shp_filename):
+    """Write the bounding box table of shp_filename."""
+    ds = osgeo.ogr.Open(shp_filename)
+    if ds is None:
+        raise IOError("Could not open shapefile %s" % shp_filename)
+    lyr = ds.GetLayer()
+    lyr.SetIgnoredFields(
+        [lyr.GetLayerDefn().GetFieldDefn(i).GetName()
+         for i in range(lyr.GetLayerDefn().GetFieldCount())])
+    rows = []
+    lyr.ResetReading()
+    feat = lyr.GetNextFeature()
+    while feat is not None:
+        geom = feat.GetGeometryRef()
+        if geom:
+            minx, maxx, miny, maxy = geom.GetEnvelope()
+            rows.append((feat.GetFID(), minx, miny, maxx, maxy))
+        feat = lyr.GetNextFeature()
+    table = numpy.array(rows, dtype=BBOX_DTYPE)
+    _write(bbox_sidecar_filename(shp_filename), shp_filename,
+           len(table), 0, [table])
+
+
+def write_id_sidecar(shp_filename, field_name):
+    """Write the sorted id table on field_name of shp_filename."""
+    ds = osgeo.ogr.Open(shp_filename)
+    if ds is None:
+        raise IOError("Could not open shapefile %s" % shp_filename)
+    lyr = ds.GetLayer()
+    layer_defn = lyr.GetLayerDefn()
+    field_index = None
+    for i in range(layer_defn.GetFieldCount()):
+        name = layer_defn.GetFieldDefn(i).GetName()
+        if name.strip() == field_name.strip():
+            field_index = i
+            break
+    if field_index is None:
+        raise KeyError("Field %s not in shapefile %s" % (
+                field_name, shp_filename))
+    kind = id_kind(layer_defn.GetFieldDefn(field_index).GetType())
+    keys, fids = [], []
+    lyr.ResetReading()
+    feat = lyr.GetNextFeature()
+    while feat is not None:
+        key = id_key(feat.GetField(field_index), kind)
+        if key is not None:
+            keys.append(key)
+            fids.append(feat.GetFID())
+        feat = lyr.GetNextFeature()
+    if kind == b'S':
+        width = max([len(key) for key in keys] + [1])
+    else:
+        width = 8
+    keys = numpy.array(keys, dtype=_key_dtype(kind, width))
+    fids = numpy.array(fids, dtype=FID_DTYPE)
+    order = numpy.argsort(keys, kind='mergesort')
+    _write(id_sidecar_filename(shp_filename, field_name), shp_filename,
+           len(keys), width, [keys[order], fids[order]], kind)
+
+
+class IdSidecar(object):
+    """Memory mapped id table, with a dict like get()."""
+    def __init__(self, filename, count, width, kind):
+        self.width = width
+        self.kind = kind
+        self.keys = _memmap(filename, _key_dtype(kind, width),
+                            HEADER.size, count)
+        self.fids = _memmap(filename, FID_DTYPE,
+                            HEADER.size + count * width, count)
+
+    def get(self, value, default=None):
+        """Return the list of FIDs of id value, or default."""
+        key = id_key(value, self.kind)
+        if key is None or (self.kind == b'S' and len(key) > self.width):
+            return default
+        if self.kind == b'i' and not -2 ** 63 <= key < 2 ** 63:
+            return default
+        start = numpy.searchsorted(self.keys, key, side='left')
+        end = numpy.searchsorted(self.keys, key, side='right')
+        if start == end:
+            return default
+        return sorted(self.fids[start:end].tolist())
+
+
+def _cached_open(filename, shp_filename, opener):
+    try:
+        mtime = (os.path.getmtime(filename), os.path.getmtime(shp_filename))
+    except OSError:
+        return None
+    with _opened_lock:
+        cached = _opened.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    header = _read_header(filename, shp_filename)
+    if header is None:
+        return None
+    opened = opener(filename, *header)
+    with _opened_lock:
+        _opened[filename] = (mtime, opened)
+    return opened
+
+
+def read_bbox_sidecar(shp_filename):
+    """Return the bbox table of shp_filename, or None if there is no
+    valid sidecar."""
+    return _cached_open(
+        bbox_sidecar_filename(shp_filename), shp_filename,
+        lambda filename, count, width, kind: _memmap(
+            filename, BBOX_DTYPE, HEADER.size, count))
+
+
+def read_id_sidecar(shp_filename, field_name):
+    """Return an IdSidecar on field_name, or None if there is no valid
+    sidecar."""
+    return _cached_open(
+        id_sidecar_filename(shp_filename, field_name), shp_filename,
+        IdSidecar)
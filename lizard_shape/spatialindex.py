@@ -0,0 +1,104 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Spatial index files of shapefiles, for mapnik and OGR.
+
+Mapnik and OGR each read their own format:
+
+* <base>.index -- written by mapnik's shapeindex tool, used by the
+  mapnik Shapefile datasource.
+
+* <base>.qix -- quadtree written by OGR (CREATE SPATIAL INDEX), used by
+  OGR spatial filters.
+
+Neither checks if the index still matches the shapefile, so stale
+indexes are removed (see remove_stale_indexes) before the shapefile is
+handed over. Configure the shapeindex executable with
+LIZARD_SHAPE_SHAPEINDEX (default: 'shapeindex').
+"""
+import logging
+import os
+import subprocess
+
+from django.conf import settings
+import osgeo.ogr
+
+logger = logging.getLogger(__name__)
+
+SHAPEINDEX = getattr(settings, 'LIZARD_SHAPE_SHAPEINDEX', 'shapeindex')
+
+
+def mapnik_index_filename(shp_filename):
+    return os.path.splitext(shp_filename)[0] + '.index'
+
+
+def qix_filename(shp_filename):
+    return os.path.splitext(shp_filename)[0] + '.qix'
+
+
+def write_qix(shp_filename):
+    """Write the OGR .qix index of shp_filename.
+
+    Returns False (and logs why) if OGR didn't write it.
+    """
+    # OGR only creates indexes on datasources opened for update.
+    ds = osgeo.ogr.Open(shp_filename, 1)
+    if ds is None:
+        raise IOError("Could not open shapefile %s for update" %
+                      shp_filename)
+    layer_name = ds.GetLayer().GetName()
+    ds.ExecuteSQL('CREATE SPATIAL INDEX ON "%s"' % layer_name)
+    ds = None  # Flushes the index.
+    if not os.path.exists(qix_filename(shp_filename)):
+        # OGR reports errors without raising them.
+        logger.warning("OGR did not write spatial index %s.",
+                       qix_filename(shp_filename))
+        return False
+    logger.info("Wrote spatial index %s.", qix_filename(shp_filename))
+    return True
+
+
+def write_mapnik_index(shp_filename):
+    """Write the mapnik .index of shp_filename with shapeindex.
+
+    Returns False (and logs why) if shapeindex is not available or
+    fails.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                [SHAPEINDEX, os.path.splitext(shp_filename)[0]],
+                stdout=devnull)
+    except OSError:
+        logger.warning("Could not run %s, no mapnik index for %s.",
+                       SHAPEINDEX, shp_filename)
+        return False
+    except subprocess.CalledProcessError:
+        logger.exception("%s failed on %s.", SHAPEINDEX, shp_filename)
+        return False
+    logger.info("Wrote spatial index %s.", mapnik_index_filename(shp_filename))
+    return True
+
+
+def write_spatial_indexes(shp_filename):
+    """Write the mapnik and OGR index of shp_filename."""
+    write_qix(shp_filename)
+    write_mapnik_index(shp_filename)
+
+
+def remove_stale_indexes(shp_filename):
+    """Remove index files of shp_filename that are older than the
+    shapefile, so mapnik and OGR don't use them."""
+    try:
+        shp_mtime = os.path.getmtime(shp_filename)
+    except OSError:
+        return
+    for index_filename in (mapnik_index_filename(shp_filename),
+                           qix_filename(shp_filename)):
+        try:
+            if os.path.getmtime(index_filename) < shp_mtime:
+                logger.warning("Removing stale spatial index %s.",
+                               index_filename)
+                os.remove(index_filename)
+        except OSError:
+            # No index, or removed by another process.
+            pass
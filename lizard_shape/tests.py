@@ -1,25 +1,79 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+from distutils.spawn import find_executable
 import datetime
+import json
+import os
+import pickle
+import shutil
+import tempfile
 
+from django.core.cache.backends.dummy import DummyCache
 from django.core.files.base import ContentFile
 from django.core.urlresolvers import reverse
 from django.db import IntegrityError
 from django.forms import ValidationError
 from django.test import TestCase
 from django.test.client import Client
+import osgeo.ogr
 import pkg_resources
 
+import lizard_shape.caching
 import lizard_shape.layers
 from lizard_shape.admin import check_extension_or_error
+from lizard_shape.caching import _search_cache
+from lizard_shape.caching import cached_style
+from lizard_shape.caching import get_search_results
+from lizard_shape.caching import legend_version
+from lizard_shape.caching import popup_cache_key
+from lizard_shape.caching import popup_cache_stats
+from lizard_shape.caching import search_cache_key
+from lizard_shape.caching import set_search_results
+from lizard_shape.columns import column_store
+from lizard_shape.columns import write_column_store
+from lizard_shape.datasources import shapefile_datasource
+from lizard_shape.export import ExportError
+from lizard_shape.export import _positions
+from lizard_shape.export import _replace_positions
+from lizard_shape.export import feature_chunks
+from lizard_shape.export import iter_csv
+from lizard_shape.export import iter_geojson
+from lizard_shape.indexes import LRUCache
+from lizard_shape.indexes import id_index
+from lizard_shape.indexes import shapefile_index
+from lizard_shape.indexes import shapefile_schema
 from lizard_shape.layers import AdapterShapefile
 from lizard_shape.layers import LEGEND_TYPE_SHAPELEGENDCLASS
+from lizard_shape.layers import google_scale
+from lizard_shape.layers import search_many
 from lizard_shape.models import Category
 from lizard_shape.models import Shape
+from lizard_shape.models import ShapeField
 from lizard_shape.models import ShapeLegend
 from lizard_shape.models import ShapeLegendClass
 from lizard_shape.models import ShapeLegendPoint
+from lizard_shape.models import ShapeLegendSingleClass
 from lizard_shape.models import ShapeTemplate
 from lizard_shape.models import ShapeNameError
+from lizard_shape.projections import shape_projection
+from lizard_shape.pyramid import PYRAMID_SCALES
+from lizard_shape.pyramid import level_filename
+from lizard_shape.pyramid import pyramid_levels
+from lizard_shape.reprojected import google_copy_filename
+from lizard_shape.rules import class_rules
+from lizard_shape.sidecar import read_bbox_sidecar
+from lizard_shape.sidecar import read_id_sidecar
+from lizard_shape.sidecar import write_bbox_sidecar
+from lizard_shape.sidecar import write_id_sidecar
+from lizard_shape.spatialindex import SHAPEINDEX
+from lizard_shape.spatialindex import remove_stale_indexes
+from lizard_shape.spatialindex import write_spatial_indexes
+from lizard_shape.tiles import GOOGLE_HALF_WORLD
+from lizard_shape.tiles import evict_tiles
+from lizard_shape.tiles import tile_bounds
+from lizard_shape.vectortiles import _source
+from lizard_shape.vectortiles import encode_tile
+from lizard_shape.vectortiles import tile_features
+from lizard_shape.views import combined_adapter_layer_json
 
 
 class IntegrationTest(TestCase):
@@ -55,6 +109,66 @@ class IntegrationTest(TestCase):
             value_field='test_field')
 
 
+class ViewsTest(TestCase):
+    """The shapefile of the fixture is not there."""
+    fixtures = ['lizard_shape_test']
+
+    def _status(self, name, data=None, **kwargs):
+        return self.client.get(reverse(name, kwargs=kwargs),
+                               data or {}).status_code
+
+    def test_tile(self):
+        tile = {'z': 1, 'x': 0, 'y': 1}
+        self.assertEquals(
+            self._status('lizard_shape.tile', slug='unknown',
+                         legend_type='ShapeLegendClass', legend_id=1,
+                         **tile),
+            404)
+        self.assertEquals(
+            self._status('lizard_shape.tile', slug='oevers',
+                         legend_type='Unknown', legend_id=1, **tile),
+            404)
+        self.assertEquals(
+            self._status('lizard_shape.tile', slug='oevers',
+                         legend_type='ShapeLegendClass', legend_id=1,
+                         z=1, x=2, y=0),
+            404)
+        # Missing shapefile.
+        self.assertEquals(
+            self._status('lizard_shape.tile', slug='oevers',
+                         legend_type='ShapeLegendClass', legend_id=1,
+                         **tile),
+            404)
+
+    def test_vector_tile(self):
+        self.assertEquals(
+            self._status('lizard_shape.vector_tile', slug='unknown',
+                         z=0, x=0, y=0),
+            404)
+        self.assertEquals(
+            self._status('lizard_shape.vector_tile', slug='oevers',
+                         z=23, x=0, y=0),
+            404)
+        self.assertEquals(
+            self._status('lizard_shape.vector_tile', slug='oevers',
+                         z=0, x=0, y=0),
+            404)
+
+    def test_export(self):
+        self.assertEquals(
+            self._status('lizard_shape.export', slug='unknown',
+                         export_format='csv'),
+            404)
+        self.assertEquals(
+            self._status('lizard_shape.export', {'bbox': '1,2,3'},
+                         slug='oevers', export_format='geojson'),
+            400)
+        self.assertEquals(
+            self._status('lizard_shape.export', slug='oevers',
+                         export_format='geojson'),
+            404)
+
+
 class ModelsTest(TestCase):
     def test_category(self):
         """Adding parents and childs.
@@ -90,3 +204,891 @@ class ModelsTest(TestCase):
         category.save()
         category.parent = category
         self.assertRaises(ValidationError, category.save)
+
+
+def _shapefile(directory, fields, features, geom_type=osgeo.ogr.wkbPoint,
+               name='points'):
+    """Write a shapefile and return its path.
+
+    fields is a list of (name, OGR field type), features a list of
+    (values, wkt) with a value (or None) for every field.
+    """
+    filename = os.path.join(directory, name + '.shp')
+    driver = osgeo.ogr.GetDriverByName('ESRI Shapefile')
+    ds = driver.CreateDataSource(filename)
+    lyr = ds.CreateLayer(name, geom_type=geom_type)
+    for field_name, field_type in fields:
+        lyr.CreateField(osgeo.ogr.FieldDefn(field_name, field_type))
+    for values, wkt in features:
+        feat = osgeo.ogr.Feature(lyr.GetLayerDefn())
+        for (field_name, _), value in zip(fields, values):
+            if value is not None:
+                feat.SetField(field_name, value)
+        feat.SetGeometry(osgeo.ogr.CreateGeometryFromWkt(wkt))
+        lyr.CreateFeature(feat)
+    ds = None  # Flushes the file.
+    return filename
+
+
+def _point_shapefile(directory, points):
+    """Write a point shapefile with an 'id' column and return its path.
+
+    points is a list of (id, x, y).
+    """
+    return _shapefile(
+        directory, [('id', osgeo.ogr.OFTString)],
+        [((identifier, ), 'POINT (%f %f)' % (x, y))
+         for identifier, x, y in points])
+
+
+# Points in RD, the default projection: (id, name, value, x, y).
+SEARCH_POINTS = [
+    (1, 'a', 1.5, 155000, 463000),
+    (2, 'b', 2.5, 155010, 463000),
+    (3, 'c', 3.5, 155003, 463004),
+    (4, 'd', 4.5, 156000, 463000)]
+
+
+def _search_shapefile(directory):
+    return _shapefile(
+        directory,
+        [('id', osgeo.ogr.OFTInteger), ('name', osgeo.ogr.OFTString),
+         ('value', osgeo.ogr.OFTReal)],
+        [((identifier, name, value), 'POINT (%f %f)' % (x, y))
+         for identifier, name, value, x, y in SEARCH_POINTS])
+
+
+def _search_adapter(filename):
+    return AdapterShapefile(None, layer_arguments={
+            'layer_name': 'test',
+            'layer_filename': filename,
+            'search_property_name': 'name',
+            'search_property_id': 'id',
+            'value_field': 'value',
+            'value_name': 'Value',
+            'display_fields': [{'name': 'Value', 'field': 'value',
+                                'field_type': 1}]})
+
+
+class _ShpFile(object):
+    def __init__(self, path):
+        self.path = path
+
+
+class _FakeShape(object):
+    """Just enough of a Shape for the export and vector tile
+    functions."""
+    id = None
+    slug = 'polygons'
+    prj = None
+
+    def __init__(self, shp_filename, template=None):
+        self.shp_file = _ShpFile(shp_filename)
+        self.template = template
+
+
+class IndexesTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = _point_shapefile(
+            self.directory,
+            [('a', 0, 0), ('b', 10, 0), ('c', 3, 4), ('d', 100, 100)])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_query(self):
+        index = shapefile_index(self.filename)
+        self.assertEquals(sorted(index.query(-1, -1, 11, 1)), [0, 1])
+
+    def test_candidates_sorted(self):
+        index = shapefile_index(self.filename)
+        candidates = index.candidates(0, 0)
+        self.assertEquals([fid for _, fid in candidates], [0, 2, 1, 3])
+        self.assertAlmostEquals(candidates[1][0], 5.0)
+
+    def test_candidates_radius(self):
+        index = shapefile_index(self.filename)
+        candidates = index.candidates(0, 0, radius=6)
+        self.assertEquals([fid for _, fid in candidates], [0, 2])
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.adapter = _search_adapter(_search_shapefile(self.directory))
+        self.x, self.y = self.adapter.projection.to_google(155000, 463000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_result(self):
+        """Result dicts look like they did before the index."""
+        result = self.adapter.search(self.x, self.y)[0]
+        self.assertEquals(
+            sorted(result.keys()),
+            ['distance', 'google_coords', 'identifier', 'name',
+             'workspace_item'])
+        self.assertAlmostEquals(result['distance'], 0)
+        self.assertTrue(result['name'].startswith('a - Value='))
+        self.assertEquals(result['identifier'], {'id': 1})
+        self.assertAlmostEquals(result['google_coords'][0], self.x, 2)
+        self.assertAlmostEquals(result['google_coords'][1], self.y, 2)
+        self.assertEquals(result['workspace_item'], None)
+
+    def test_order(self):
+        results = self.adapter.search(self.x, self.y)
+        self.assertEquals([result['identifier']['id'] for result in results],
+                          [1, 3, 2])
+        distances = [result['distance'] for result in results]
+        self.assertEquals(distances, sorted(distances))
+
+    def test_max_results(self):
+        results = self.adapter.search(self.x, self.y, max_results=2)
+        self.assertEquals([result['identifier']['id'] for result in results],
+                          [1, 3])
+        self.assertEquals(self.adapter.search(self.x, self.y,
+                                              max_results=0), [])
+        results = self.adapter.search(self.x, self.y, max_results=10)
+        self.assertEquals([result['identifier']['id'] for result in results],
+                          [1, 3, 2, 4])
+
+    def test_radius(self):
+        """Features at radius or further are left out (radius is in RD
+        here)."""
+        results = self.adapter._search_native(155000, 463000, 6, 3)
+        self.assertEquals([result['identifier']['id'] for result in results],
+                          [1, 3])
+        results = self.adapter._search_native(155000, 463000, 5, 3)
+        self.assertEquals([result['identifier']['id'] for result in results],
+                          [1])
+
+    def test_search_many(self):
+        other_directory = tempfile.mkdtemp()
+        try:
+            other_filename = _shapefile(
+                other_directory,
+                [('id', osgeo.ogr.OFTInteger),
+                 ('name', osgeo.ogr.OFTString),
+                 ('value', osgeo.ogr.OFTReal)],
+                [((5, 'e', 5.5), 'POINT (155001 463000)')])
+            results = search_many(
+                [self.adapter,
+                 _search_adapter(other_filename).layer_arguments],
+                self.x, self.y)
+            self.assertEquals([result['name'][0] for result in results],
+                              ['a', 'e', 'c', 'b'])
+            # Distances are in google units.
+            scale = google_scale(self.adapter.projection, self.x, self.y)
+            self.assertAlmostEquals(results[1]['distance'], scale, 3)
+        finally:
+            shutil.rmtree(other_directory)
+
+    def test_google_scale(self):
+        scale = google_scale(self.adapter.projection, self.x, self.y)
+        # Google is stretched by about 1 / cos(52 degrees) in NL.
+        self.assertTrue(1.5 < scale < 1.7)
+
+    def test_location(self):
+        """The identifier of a search result finds the feature back."""
+        result = self.adapter.search(self.x, self.y)[1]
+        location = self.adapter.location(result['identifier']['id'])
+        self.assertEquals(location['identifier'], result['identifier'])
+        self.assertEquals(location['name'], 'c')
+
+    def test_no_search_property_name(self):
+        self.adapter.search_property_name = ''
+        self.assertEquals(self.adapter.search(self.x, self.y), [])
+
+
+class LocationTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.adapter = _search_adapter(_search_shapefile(self.directory))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_location(self):
+        location = self.adapter.location(3)
+        self.assertEquals(location['name'], 'c')
+        self.assertEquals(location['identifier'], {'id': 3})
+        self.assertAlmostEquals(location['value'], 3.5)
+        self.assertEquals(len(location['values']), 1)
+        self.assertEquals(location['values'][0]['name'], 'Value')
+        self.assertAlmostEquals(location['values'][0]['value'], 3.5)
+
+    def test_location_ids(self):
+        locations = self.adapter.location(None, ids=[{'id': 4}, {'id': 2}])
+        self.assertEquals([location['name'] for location in locations],
+                          ['b', 'd'])
+
+    def test_force_list(self):
+        locations = self.adapter.location(1, force_list=True)
+        self.assertEquals([location['name'] for location in locations],
+                          ['a'])
+
+    def test_unknown_id(self):
+        self.assertEquals(self.adapter.location(99), [])
+
+    def _iter_names(self, ids, file_order=False):
+        return [location['name'] for location in self.adapter.iter_location(
+                [{'id': identifier} for identifier in ids],
+                file_order=file_order)]
+
+    def test_iter_location_order(self):
+        self.assertEquals(self._iter_names([3, 1, 2]), ['c', 'a', 'b'])
+        self.assertEquals(self._iter_names([3, 1, 2], file_order=True),
+                          ['a', 'b', 'c'])
+
+    def test_iter_location_duplicates(self):
+        self.assertEquals(self._iter_names([2, 2, 1, 2]), ['b', 'a'])
+        self.assertEquals(self._iter_names([2, 99]), ['b'])
+
+
+class SearchCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = _search_shapefile(self.directory)
+        self.adapter = _search_adapter(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _key(self, x, y, radius=100):
+        return search_cache_key(self.adapter, x, y, radius, 3)
+
+    def test_grid(self):
+        """With radius 100 the grid cells are 10 wide."""
+        self.assertEquals(self._key(1001, 2001), self._key(1009, 2008))
+        self.assertNotEquals(self._key(1001, 2001), self._key(1011, 2001))
+        self.assertNotEquals(self._key(1001, 2001), self._key(1001, 1999))
+
+    def test_mtime(self):
+        key = self._key(1001, 2001)
+        mtime = os.path.getmtime(self.filename)
+        os.utime(self.filename, (mtime + 10, mtime + 10))
+        self.assertNotEquals(self._key(1001, 2001), key)
+
+    def test_no_radius(self):
+        self.assertEquals(self._key(1001, 2001, radius=None), None)
+        self.assertEquals(self._key(1001, 2001, radius=0), None)
+
+    def test_workspace_item(self):
+        key = self._key(1001, 2001)
+        workspace_item = object()
+        set_search_results(key, [{'name': 'a',
+                                  'workspace_item': workspace_item}])
+        self.assertEquals(_search_cache.get(key), [{'name': 'a'}])
+        results = get_search_results(key, workspace_item)
+        self.assertEquals(len(results), 1)
+        self.assertTrue(results[0]['workspace_item'] is workspace_item)
+
+    def test_search_cached(self):
+        x, y = self.adapter.projection.to_google(155000, 463000)
+        results = self.adapter.search(x, y, radius=10)
+        self.assertEquals(_search_cache.get(self._key(x, y, radius=10)),
+                          [dict((key, value) for key, value in
+                                result.items() if key != 'workspace_item')
+                           for result in results])
+        self.assertEquals(self.adapter.search(x, y, radius=10), results)
+
+
+class PopupCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.adapter = _search_adapter(_search_shapefile(self.directory))
+        self.identifiers = [{'id': 2}, {'id': 1}]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hit(self):
+        popup = self.adapter.html(identifiers=self.identifiers)
+        self.assertTrue('2.5' in popup)
+        hits = popup_cache_stats()['hits']
+        self.assertEquals(self.adapter.html(identifiers=self.identifiers),
+                          popup)
+        self.assertEquals(popup_cache_stats()['hits'], hits + 1)
+
+    def test_identifier_order(self):
+        """The order of the identifiers doesn't matter."""
+        self.assertEquals(
+            popup_cache_key(self.adapter, self.identifiers, False),
+            popup_cache_key(self.adapter, self.identifiers[::-1], False))
+        self.assertNotEquals(
+            popup_cache_key(self.adapter, self.identifiers, False),
+            popup_cache_key(self.adapter, self.identifiers, True))
+
+    def test_invalidated_by_signals(self):
+        key = popup_cache_key(self.adapter, self.identifiers, False)
+        template = ShapeTemplate(name='popup test')
+        template.save()
+        saved_key = popup_cache_key(self.adapter, self.identifiers, False)
+        self.assertNotEquals(saved_key, key)
+        template.delete()
+        self.assertNotEquals(
+            popup_cache_key(self.adapter, self.identifiers, False),
+            saved_key)
+
+    def test_miss_after_invalidation(self):
+        self.adapter.html(identifiers=self.identifiers)
+        ShapeTemplate(name='popup test').save()
+        misses = popup_cache_stats()['misses']
+        self.adapter.html(identifiers=self.identifiers)
+        self.assertEquals(popup_cache_stats()['misses'], misses + 1)
+
+
+class StyleCacheTest(TestCase):
+    def setUp(self):
+        template = ShapeTemplate(name='style test')
+        template.save()
+        self.legend = ShapeLegendClass(
+            descriptor='style test', shape_template=template,
+            value_field='value')
+        self.legend.save()
+
+    def _version(self):
+        return legend_version(LEGEND_TYPE_SHAPELEGENDCLASS, self.legend.id)
+
+    def test_legend_saved(self):
+        version = self._version()
+        self.assertEquals(self._version(), version)
+        self.legend.save()
+        self.assertNotEquals(self._version(), version)
+
+    def test_single_class_saved(self):
+        version = self._version()
+        single_class = ShapeLegendSingleClass(
+            shape_legend_class=self.legend, max_value='10')
+        single_class.save()
+        saved_version = self._version()
+        self.assertNotEquals(saved_version, version)
+        single_class.delete()
+        self.assertNotEquals(self._version(), saved_version)
+
+    def test_dummy_cache(self):
+        """Without a working cache, styles are rebuilt every time."""
+        style_cache = lizard_shape.caching._style_cache
+        lizard_shape.caching._style_cache = DummyCache('dummy', {})
+        try:
+            version = self._version()
+            self.assertNotEquals(version, None)
+            self.assertNotEquals(self._version(), version)
+        finally:
+            lizard_shape.caching._style_cache = style_cache
+
+    def test_cached_style(self):
+        made = []
+
+        def make_style():
+            made.append(1)
+            return len(made)
+
+        args = (LEGEND_TYPE_SHAPELEGENDCLASS, self.legend.id, 'value',
+                make_style)
+        self.assertEquals(cached_style(*args), 1)
+        self.assertEquals(cached_style(*args), 1)
+        ShapeLegendSingleClass(shape_legend_class=self.legend,
+                               min_value='10').save()
+        self.assertEquals(cached_style(*args), 2)
+
+
+class CombinedLegendsTest(TestCase):
+    """A layer with the legends of a template with two legends."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = _search_shapefile(self.directory)
+        template = ShapeTemplate(name='legends test', id_field='id',
+                                 name_field='name')
+        template.save()
+        self.legends = []
+        for descriptor, value_field, single_class in (
+            ('values', 'value',
+             ShapeLegendSingleClass(max_value='2', label='low',
+                                    color='ff0000')),
+            ('names', 'name',
+             ShapeLegendSingleClass(min_value='a', is_exact=True,
+                                    label='is a', color='00ff00'))):
+            legend = ShapeLegendClass(
+                descriptor=descriptor, shape_template=template,
+                value_field=value_field)
+            legend.save()
+            single_class.shape_legend_class = legend
+            single_class.save()
+            self.legends.append(legend)
+        self.layer_arguments = json.loads(combined_adapter_layer_json(
+                _FakeShape(self.filename), self.legends))
+        self.adapter = AdapterShapefile(
+            None, layer_arguments=self.layer_arguments)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_layer_arguments(self):
+        self.assertEquals(self.layer_arguments['layer_name'],
+                          'values + names')
+        self.assertEquals(self.layer_arguments['legend_id'],
+                          self.legends[0].id)
+        self.assertEquals(self.layer_arguments['value_field'], 'value')
+        self.assertEquals(self.layer_arguments['extra_legends'],
+                          [{'legend_type': LEGEND_TYPE_SHAPELEGENDCLASS,
+                            'legend_id': self.legends[1].id,
+                            'value_field': 'name'}])
+
+    def _style_names(self):
+        return ['Area style %s::%s::%s::%s' % (
+                self.filename, LEGEND_TYPE_SHAPELEGENDCLASS, legend.id,
+                legend.value_field) for legend in self.legends]
+
+    def test_mapnik_styles(self):
+        self.assertEquals(
+            [name for name, _ in self.adapter._mapnik_styles()],
+            self._style_names())
+
+    def test_layer(self):
+        layers, styles = self.adapter.layer(google=False)
+        self.assertEquals(sorted(styles.keys()), sorted(self._style_names()))
+        self.assertEquals(len(layers), 1)
+        self.assertEquals(list(layers[0].styles), self._style_names())
+        self.assertTrue(layers[0].cache_features)
+
+    def test_single_legend_layer(self):
+        self.layer_arguments['extra_legends'] = []
+        adapter = AdapterShapefile(None, layer_arguments=self.layer_arguments)
+        layers, styles = adapter.layer(google=False)
+        self.assertEquals(list(layers[0].styles), self._style_names()[:1])
+        self.assertFalse(layers[0].cache_features)
+
+    def test_legend(self):
+        self.assertEquals(
+            [row['description'] for row in self.adapter.legend()],
+            ['low', 'is a'])
+
+
+class ProjectionsTest(TestCase):
+    def test_round_trip(self):
+        projection = shape_projection(None)
+        google_x, google_y = projection.to_google(155000, 463000)
+        x, y = projection.from_google(google_x, google_y)
+        self.assertAlmostEquals(x, 155000, 2)
+        self.assertAlmostEquals(y, 463000, 2)
+        many = projection.to_google_many([(155000, 463000)])
+        self.assertAlmostEquals(many[0][0], google_x, 2)
+        self.assertAlmostEquals(many[0][1], google_y, 2)
+
+
+class LRUCacheTest(TestCase):
+    def test_budget(self):
+        cache = LRUCache(10)
+        cache.set('a', 1, size=4)
+        cache.set('b', 2, size=4)
+        cache.get('a')  # 'b' is now least recently used.
+        cache.set('c', 3, size=4)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('c'), 3)
+        self.assertEquals(cache.size, 8)
+
+    def test_too_big(self):
+        cache = LRUCache(10)
+        cache.set('a', 1, size=11)
+        self.assertEquals(len(cache), 0)
+
+
+class SidecarTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = _point_shapefile(
+            self.directory,
+            [('a', 0, 0), ('b', 10, 0), ('a', 3, 4)])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_missing(self):
+        self.assertEquals(read_bbox_sidecar(self.filename), None)
+        self.assertEquals(read_id_sidecar(self.filename, 'id'), None)
+
+    def test_bbox(self):
+        write_bbox_sidecar(self.filename)
+        table = read_bbox_sidecar(self.filename)
+        self.assertEquals(table['fid'].tolist(), [0, 1, 2])
+        self.assertEquals(table['maxx'].tolist(), [0, 10, 3])
+
+    def test_id(self):
+        write_id_sidecar(self.filename, 'id')
+        sidecar = read_id_sidecar(self.filename, 'id')
+        self.assertEquals(sidecar.get('a'), [0, 2])
+        self.assertEquals(sidecar.get('b'), [1])
+        self.assertEquals(sidecar.get('c'), None)
+
+    def test_typed_ids(self):
+        """Sidecars and in-process indexes match ids the same way."""
+        filename = _shapefile(
+            self.directory,
+            [('num', osgeo.ogr.OFTInteger), ('real', osgeo.ogr.OFTReal)],
+            [((3, 3.0), 'POINT (0 0)'),
+             ((4, 4.5), 'POINT (1 1)'),
+             ((None, None), 'POINT (2 2)')],
+            name='typed')
+        ds = osgeo.ogr.Open(filename)
+        lyr = ds.GetLayer()
+        schema = shapefile_schema(filename, lyr)
+        for field, fractional in (('num', None), ('real', [1])):
+            in_process = id_index(filename, field, lyr, schema)
+            write_id_sidecar(filename, field)
+            sidecar = read_id_sidecar(filename, field)
+            for index in (in_process, sidecar):
+                self.assertEquals(index.get(3), [0])
+                self.assertEquals(index.get('3'), [0])
+                self.assertEquals(index.get(3.0), [0])
+                self.assertEquals(index.get(4.5), fractional)
+                self.assertEquals(index.get(None), None)
+                self.assertEquals(index.get('None'), None)
+                self.assertEquals(index.get('x'), None)
+
+    def test_stale(self):
+        write_id_sidecar(self.filename, 'id')
+        mtime = os.path.getmtime(self.filename)
+        os.utime(self.filename, (mtime + 10, mtime + 10))
+        self.assertEquals(read_id_sidecar(self.filename, 'id'), None)
+
+
+class ColumnStoreTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = _point_shapefile(
+            self.directory,
+            [('a', 0, 0), ('b', 10, 0), ('a', 3, 4)])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_value(self):
+        store = column_store(self.filename)
+        self.assertEquals(store.value('id', 1), 'b')
+        self.assertTrue(store.has_geometry(1))
+        self.assertEquals(store.row(2), {'id': 'a'})
+
+    def test_find(self):
+        store = column_store(self.filename)
+        self.assertEquals(store.find('id', 'a'), [0, 2])
+
+    def test_record(self):
+        record = column_store(self.filename).record(1)
+        self.assertEquals(record['id'], 'b')
+        self.assertEquals(record.get('missing'), None)
+        self.assertEquals(dict(record.items()), {'id': 'b'})
+        self.assertEquals(pickle.loads(pickle.dumps(record)), record)
+
+    def test_integer64(self):
+        filename = _shapefile(
+            self.directory, [('big', osgeo.ogr.OFTInteger64)],
+            [((12345678901,), 'POINT (0 0)')], name='big')
+        self.assertEquals(column_store(filename).value('big', 0),
+                          12345678901)
+
+    def test_nulls(self):
+        filename = _shapefile(
+            self.directory,
+            [('num', osgeo.ogr.OFTInteger), ('real', osgeo.ogr.OFTReal),
+             ('text', osgeo.ogr.OFTString)],
+            [((1, 1.5, 'x' * 100), 'POINT (0 0)'),
+             ((None, None, None), 'POINT (1 1)')],
+            name='nulls')
+        store = column_store(filename)
+        self.assertEquals(store.row(0),
+                          {'num': 1, 'real': 1.5, 'text': 'x' * 100})
+        self.assertEquals(store.row(1),
+                          {'num': None, 'real': None, 'text': None})
+        self.assertEquals(store.find('num', 0), [])
+
+    def test_keeps_valid_store(self):
+        """Other processes may be reading a valid store."""
+        write_column_store(self.filename)
+        meta_filename = os.path.join(
+            self.directory, 'points.columns', 'meta.json')
+        inode = os.stat(meta_filename).st_ino
+        store = write_column_store(self.filename)
+        self.assertEquals(os.stat(meta_filename).st_ino, inode)
+        self.assertEquals(store.value('id', 1), 'b')
+        self.assertEquals(
+            [name for name in os.listdir(self.directory)
+             if name.endswith('.tmp')], [])
+
+    def test_written(self):
+        column_store(self.filename)
+        self.assertTrue(os.path.exists(
+                os.path.join(self.directory, 'points.columns', 'meta.json')))
+
+
+class ExportTest(TestCase):
+    def test_positions(self):
+        coords = [[(0, 0), (1, 0), (1, 1), (0, 0)], [(5, 5), (6, 6)]]
+        positions = list(_positions(coords))
+        self.assertEquals(len(positions), 6)
+        replaced = _replace_positions(
+            coords, iter([(x + 10, y) for x, y in positions]))
+        self.assertEquals(replaced[1], [(15, 5), (16, 6)])
+
+
+class FeatureChunksTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        filename = _shapefile(
+            self.directory,
+            [('id', osgeo.ogr.OFTInteger64), ('name', osgeo.ogr.OFTString),
+             ('value', osgeo.ogr.OFTReal), ('secret', osgeo.ogr.OFTString)],
+            [((1, 'a', 1.5, 's'), 'POINT (155000 463000)'),
+             ((12345678901, 'b', 2.5, 's'), 'POINT (155010 463000)'),
+             ((3, 'c', 3.5, 's'), 'POINT (160000 463000)')])
+        template = ShapeTemplate(name='export test', id_field='id')
+        template.save()
+        for field in ('id', 'name', 'value'):
+            ShapeField(name=field, field=field,
+                       shape_template=template).save()
+        self.shape = _FakeShape(filename, template)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _names(self, **kwargs):
+        return [properties['name']
+                for chunk in feature_chunks(self.shape, **kwargs)
+                for properties, _ in chunk]
+
+    def test_all(self):
+        chunks = list(feature_chunks(self.shape))
+        properties = [feature[0] for chunk in chunks for feature in chunk]
+        self.assertEquals(properties[1],
+                          {'id': 12345678901, 'name': 'b', 'value': 2.5})
+        self.assertEquals(len(properties), 3)
+
+    def test_ids(self):
+        self.assertEquals(self._names(ids=['12345678901']), ['b'])
+        self.assertEquals(self._names(ids=['3', '1']), ['a', 'c'])
+        self.assertEquals(self._names(ids=['4']), [])
+        self.assertRaises(ExportError, feature_chunks, self.shape,
+                          ids=['x'])
+
+    def test_attribute(self):
+        self.assertEquals(self._names(attribute='id', value='3'), ['c'])
+        self.assertEquals(self._names(attribute='name', value='b'), ['b'])
+        # Only ShapeField columns can be filtered.
+        self.assertRaises(ExportError, feature_chunks, self.shape,
+                          attribute='secret', value='s')
+
+    def test_bbox(self):
+        projection = shape_projection(None)
+        minx, miny = projection.to_google(154990, 462990)
+        maxx, maxy = projection.to_google(155020, 463010)
+        bbox = (minx, miny, maxx, maxy)
+        self.assertEquals(self._names(bbox=bbox, srs='google'), ['a', 'b'])
+        self.assertEquals(
+            self._names(bbox=bbox, srs='google', ids=['1', '3']), ['a'])
+
+    def test_geojson(self):
+        collection = json.loads(''.join(iter_geojson(
+                    feature_chunks(self.shape, srs='google'))))
+        self.assertEquals(collection['type'], 'FeatureCollection')
+        self.assertEquals(len(collection['features']), 3)
+        feature = collection['features'][0]
+        self.assertEquals(feature['properties'],
+                          {'id': 1, 'name': 'a', 'value': 1.5})
+        self.assertEquals(feature['geometry']['type'], 'Point')
+        x, y = shape_projection(None).to_google(155000, 463000)
+        self.assertAlmostEquals(feature['geometry']['coordinates'][0], x, 2)
+        self.assertAlmostEquals(feature['geometry']['coordinates'][1], y, 2)
+
+    def test_csv(self):
+        rows = ''.join(iter_csv(feature_chunks(self.shape, ids=['1']),
+                                ['id', 'name', 'value'])).splitlines()
+        self.assertEquals(len(rows), 2)
+        self.assertEquals(rows[0], 'id,name,value,wkt')
+        self.assertTrue(rows[1].startswith('1,a,1.5,POINT ('))
+
+
+class SpatialIndexTest(TestCase):
+    def test_remove_stale_indexes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = _point_shapefile(directory, [('a', 0, 0)])
+            mtime = os.path.getmtime(filename)
+            for extension, index_mtime in (('.qix', mtime - 10),
+                                           ('.index', mtime)):
+                index_filename = os.path.join(directory,
+                                              'points' + extension)
+                open(index_filename, 'wb').close()
+                os.utime(index_filename, (index_mtime, index_mtime))
+            remove_stale_indexes(filename)
+            self.assertFalse(os.path.exists(
+                    os.path.join(directory, 'points.qix')))
+            self.assertTrue(os.path.exists(
+                    os.path.join(directory, 'points.index')))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_write_spatial_indexes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = _point_shapefile(directory, [('a', 0, 0)])
+            write_spatial_indexes(filename)
+            self.assertTrue(os.path.exists(
+                    os.path.join(directory, 'points.qix')))
+            if find_executable(SHAPEINDEX):
+                self.assertTrue(os.path.exists(
+                        os.path.join(directory, 'points.index')))
+        finally:
+            shutil.rmtree(directory)
+
+
+class DatasourcesTest(TestCase):
+    def test_pooled(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = _point_shapefile(directory, [('a', 0, 0)])
+            datasource = shapefile_datasource(filename)
+            self.assertTrue(shapefile_datasource(filename) is datasource)
+            mtime = os.path.getmtime(filename)
+            os.utime(filename, (mtime + 10, mtime + 10))
+            self.assertFalse(shapefile_datasource(filename) is datasource)
+        finally:
+            shutil.rmtree(directory)
+
+
+class PyramidTest(TestCase):
+    def test_pyramid_levels(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'lines.shp')
+            copy_filename = google_copy_filename(filename)
+            scale = PYRAMID_SCALES[0]
+            for name in (filename, copy_filename,
+                         level_filename(filename, scale)):
+                open(name, 'wb').close()
+            self.assertEquals(pyramid_levels(filename),
+                              [(None, scale, copy_filename),
+                               (scale, None,
+                                level_filename(filename, scale))])
+            os.remove(copy_filename)
+            self.assertEquals(pyramid_levels(filename), [])
+        finally:
+            shutil.rmtree(directory)
+
+
+class RulesTest(TestCase):
+    def test_class_rules(self):
+        classes = [
+            ShapeLegendSingleClass(min_value='10', max_value='20'),
+            ShapeLegendSingleClass(max_value='10'),
+            ShapeLegendSingleClass(min_value='15', max_value='30'),
+            ShapeLegendSingleClass(),
+            ShapeLegendSingleClass(min_value='a', is_exact=True),
+            ShapeLegendSingleClass(min_value='40')]
+        rules, default = class_rules(classes, 'v')
+        self.assertEquals(
+            [(mapnik_filter, classes.index(c)) for mapnik_filter, c in rules],
+            [("[v] = 'a'", 4),
+             ('[v] < 10', 1),
+             ('[v] < 20', 0),
+             ('[v] < 30', 2),
+             ('[v] >= 40', 5)])
+        self.assertTrue(default is classes[3])
+
+    def test_open_ended(self):
+        """The last range keeps its lower bound, so empty values and
+        values that are no numbers get the default."""
+        classes = [
+            ShapeLegendSingleClass(max_value='10'),
+            ShapeLegendSingleClass(min_value='10'),
+            ShapeLegendSingleClass()]
+        rules, default = class_rules(classes, 'v')
+        self.assertEquals(
+            [(mapnik_filter, classes.index(c)) for mapnik_filter, c in rules],
+            [('[v] < 10', 0),
+             ('[v] >= 10', 1)])
+        self.assertTrue(default is classes[2])
+
+
+class TilesTest(TestCase):
+    def test_tile_bounds(self):
+        minx, miny, maxx, maxy = tile_bounds(1, 1, 0)
+        self.assertAlmostEqual(minx, 0)
+        self.assertAlmostEqual(miny, 0)
+        self.assertAlmostEqual(maxx, 20037508.342789244)
+        self.assertAlmostEqual(maxy, 20037508.342789244)
+        self.assertEquals(tile_bounds(2, 0, 0, 2, 2)[:2],
+                          tile_bounds(1, 0, 0)[:2])
+
+    def test_evict_tiles(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for i in range(10):
+                filename = os.path.join(directory, '%d.png' % i)
+                with open(filename, 'wb') as f:
+                    f.write(b'x' * 100)
+                os.utime(filename, (i, i))
+            self.assertEquals(evict_tiles(directory, 1000), 0)
+            self.assertEquals(evict_tiles(directory, 500), 6)
+            self.assertFalse(os.path.exists(os.path.join(directory, '0.png')))
+            self.assertTrue(os.path.exists(os.path.join(directory, '9.png')))
+        finally:
+            shutil.rmtree(directory)
+
+
+class VectorTilesTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shp_filename = _shapefile(
+            self.directory, [('value', osgeo.ogr.OFTReal)],
+            [((1.5,), 'POLYGON ((155000 463000, 155100 463000, '
+              '155100 463100, 155000 463100, 155000 463000))'),
+             # Bow tie: self-intersecting, invalid.
+             ((2.5,), 'POLYGON ((155000 463000, 155100 463100, '
+              '155100 463000, 155000 463100, 155000 463000))')],
+            geom_type=osgeo.ogr.wkbPolygon, name='polygons')
+        self.shape = _FakeShape(shp_filename)
+        # The tile at zoom level 12 containing the polygons.
+        google_x, google_y = shape_projection(None).to_google(
+            155050, 463050)
+        self.z = 12
+        size = 2 * GOOGLE_HALF_WORLD / 2 ** self.z
+        self.x = int((google_x + GOOGLE_HALF_WORLD) // size)
+        self.y = int((GOOGLE_HALF_WORLD - google_y) // size)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_tile_features(self):
+        features = tile_features(self.shape, self.z, self.x, self.y,
+                                 ['value', 'missing'])
+        self.assertEquals([feature['properties'] for feature in features],
+                          [{'value': 1.5}, {'value': 2.5}])
+        for feature in features:
+            self.assertTrue(feature['geometry'].is_valid)
+            self.assertFalse(feature['geometry'].is_empty)
+
+    def test_empty_tile(self):
+        self.assertEquals(tile_features(self.shape, self.z, 0, 0, []), [])
+
+    def test_encode_tile(self):
+        data = encode_tile(self.shape, self.z, self.x, self.y, ['value'])
+        self.assertTrue(isinstance(data, bytes))
+        self.assertTrue(len(data) > 0)
+
+    def test_source(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'lines.shp')
+            open(filename, 'wb').close()
+            self.assertEquals(_source(filename, 0), (filename, False))
+            copy_filename = google_copy_filename(filename)
+            simplified_filename = level_filename(filename, PYRAMID_SCALES[0])
+            for name in (copy_filename, simplified_filename):
+                open(name, 'wb').close()
+            self.assertEquals(_source(filename, 20), (copy_filename, True))
+            self.assertEquals(_source(filename, 0),
+                              (simplified_filename, True))
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,227 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Disk cache of rendered png tiles (XYZ, google) of shape layers.
+
+Tiles are rendered per metatile of METATILE x METATILE tiles, which is
+cut up and stored as <dir>/<shape id>/<key>/<z>/<x>/<y>.png. The key
+contains the legends, value fields, legend versions (see
+lizard_shape.caching) and the mtime of the shapefile, so a new upload or
+legend change leads to new tiles. Vector tiles (see
+lizard_shape.vectortiles) are stored in the same directory. Old tiles
+are evicted least recently used first.
+
+Configure it in your settings:
+
+* LIZARD_SHAPE_TILE_CACHE_DIR -- directory (default: lizard_shape_tiles
+  in the temp directory).
+
+* LIZARD_SHAPE_TILE_CACHE_BYTES -- size limit of the directory
+  (default: 512MB).
+
+* LIZARD_SHAPE_METATILE -- tiles per side of a metatile (default: 4).
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+import mapnik
+
+from lizard_map.coordinates import GOOGLE
+from lizard_shape.caching import legend_version
+
+logger = logging.getLogger(__name__)
+
+TILE_CACHE_DIR = getattr(
+    settings, 'LIZARD_SHAPE_TILE_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'lizard_shape_tiles'))
+TILE_CACHE_BYTES = getattr(
+    settings, 'LIZARD_SHAPE_TILE_CACHE_BYTES', 512 * 1024 * 1024)
+METATILE = getattr(settings, 'LIZARD_SHAPE_METATILE', 4)
+TILE_SIZE = 256
+# Pixels rendered around a metatile, so symbols on the edges are not cut.
+BUFFER_SIZE = 64
+MAX_ZOOM = 22
+# Extensions of cached tiles: png and vector tiles.
+TILE_EXTENSIONS = ('.png', '.pbf')
+# Half the width of the google world, in meters.
+GOOGLE_HALF_WORLD = 20037508.342789244
+# Evict after this part of the size limit has been written.
+EVICT_FRACTION = 0.1
+# Metatiles are rendered under one of these locks, so threads don't
+# render the same metatile twice.
+_render_locks = [threading.Lock() for _ in range(64)]
+_written = [0]
+_written_lock = threading.Lock()
+
+
+def tile_bounds(z, x, y, columns=1, rows=1):
+    """Return google (minx, miny, maxx, maxy) of columns x rows tiles,
+    starting with tile x, y at zoom level z (y counted from the top)."""
+    size = 2 * GOOGLE_HALF_WORLD / 2 ** z
+    minx = -GOOGLE_HALF_WORLD + x * size
+    maxy = GOOGLE_HALF_WORLD - y * size
+    return minx, maxy - rows * size, minx + columns * size, maxy
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_directory(adapter, directory=None):
+    """Return the cache directory of the tiles of adapter's current
+    shapefile and legend."""
+    legends = []
+    if adapter.legend_id is not None:
+        legends.append((adapter.legend_type, adapter.legend_id,
+                        adapter.value_field))
+        legends.extend((extra['legend_type'], extra['legend_id'],
+                        extra['value_field'])
+                       for extra in adapter.extra_legends)
+    config = (adapter.layer_filename,
+              os.path.getmtime(adapter.layer_filename),
+              [(legend_type, legend_id, value_field,
+                legend_version(legend_type, legend_id))
+               for legend_type, legend_id, value_field in legends])
+    return os.path.join(
+        directory or TILE_CACHE_DIR, str(adapter.shape_id),
+        hashlib.md5(repr(config).encode('utf-8')).hexdigest())
+
+
+def tile_filename(base_directory, z, x, y, extension='png'):
+    return os.path.join(base_directory, str(z), str(x),
+                        '%d.%s' % (y, extension))
+
+
+def render_metatile(adapter, z, mx, my):
+    """Render metatile mx, my at zoom level z of adapter.
+
+    Returns {(x, y): png data} of the tiles in it.
+    """
+    x0, y0 = mx * METATILE, my * METATILE
+    columns = min(METATILE, 2 ** z - x0)
+    rows = min(METATILE, 2 ** z - y0)
+    mapnik_map = mapnik.Map(columns * TILE_SIZE, rows * TILE_SIZE, GOOGLE)
+    mapnik_map.buffer_size = BUFFER_SIZE
+    layers, styles = adapter.layer(google=True)
+    for name, style in styles.items():
+        mapnik_map.append_style(name, style)
+    for layer in layers:
+        mapnik_map.layers.append(layer)
+    mapnik_map.zoom_to_box(
+        mapnik.Box2d(*tile_bounds(z, x0, y0, columns, rows)))
+    image = mapnik.Image(mapnik_map.width, mapnik_map.height)
+    mapnik.render(mapnik_map, image)
+
+    tiles = {}
+    for column in range(columns):
+        for row in range(rows):
+            view = image.view(column * TILE_SIZE, row * TILE_SIZE,
+                              TILE_SIZE, TILE_SIZE)
+            tiles[(x0 + column, y0 + row)] = view.tostring('png')
+    return tiles
+
+
+def write_tile(filename, data):
+    tile_dir = os.path.dirname(filename)
+    try:
+        os.makedirs(tile_dir)
+    except OSError:
+        if not os.path.isdir(tile_dir):
+            raise
+    temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(temp_filename, 'wb') as f:
+        f.write(data)
+    os.rename(temp_filename, filename)
+
+
+def read_tile(filename):
+    """Return the data of a cached tile, or None. Marks it as used."""
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        # The mtime is the time of last use, for the eviction.
+        os.utime(filename, None)
+    except (IOError, OSError):
+        return None
+    return data
+
+
+def get_tile(adapter, z, x, y, directory=None):
+    """Return png data of tile z, x, y of adapter, rendering and caching
+    its metatile if it is not in the cache."""
+    base_directory = tile_directory(adapter, directory)
+    filename = tile_filename(base_directory, z, x, y)
+    data = read_tile(filename)
+    if data is not None:
+        return data
+
+    mx, my = x // METATILE, y // METATILE
+    lock = _render_locks[hash((base_directory, z, mx, my)) %
+                         len(_render_locks)]
+    with lock:
+        # Another thread may have rendered it in the meantime.
+        data = read_tile(filename)
+        if data is not None:
+            return data
+        tiles = render_metatile(adapter, z, mx, my)
+        written = 0
+        try:
+            for (tile_x, tile_y), tile_data in tiles.items():
+                write_tile(tile_filename(base_directory, z, tile_x, tile_y),
+                            tile_data)
+                written += len(tile_data)
+        except (IOError, OSError):
+            logger.exception("Could not write tiles to %s.", base_directory)
+    tiles_written(written, directory)
+    return tiles[(x, y)]
+
+
+def tiles_written(size, directory=None):
+    """Count written bytes, evict tiles when enough has been written."""
+    max_bytes = TILE_CACHE_BYTES
+    with _written_lock:
+        _written[0] += size
+        if _written[0] < max_bytes * EVICT_FRACTION:
+            return
+        _written[0] = 0
+    evict_tiles(directory, max_bytes)
+
+
+def evict_tiles(directory=None, max_bytes=None):
+    """Remove the least recently used tiles until the cache directory is
+    below 90% of max_bytes. Returns the number of removed tiles."""
+    directory = directory or TILE_CACHE_DIR
+    if max_bytes is None:
+        max_bytes = TILE_CACHE_BYTES
+    tiles = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            if not name.endswith(TILE_EXTENSIONS):
+                continue
+            filename = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            tiles.append((stat.st_mtime, stat.st_size, filename))
+            total += stat.st_size
+    if total <= max_bytes:
+        return 0
+
+    removed = 0
+    tiles.sort()
+    for mtime, size, filename in tiles:
+        if total <= max_bytes * 0.9:
+            break
+        try:
+            os.remove(filename)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    logger.info("Evicted %d tiles from %s.", removed, directory)
+    return removed
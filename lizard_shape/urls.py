@@ -6,6 +6,9 @@ from django.views.i18n import javascript_catalog
 
 from lizard_ui.urls import debugmode_urlpatterns
 from lizard_shape.views import HomepageView
+from lizard_shape.views import shape_export
+from lizard_shape.views import shape_tile
+from lizard_shape.views import shape_vector_tile
 
 urlpatterns = patterns(
     '',
@@ -15,6 +18,17 @@ urlpatterns = patterns(
     url(r'^category/(?P<root_slug>.*)/$',
         HomepageView.as_view(),
         name='lizard_shape.homepage'),
+    url(r'^shape/(?P<slug>[^/]+)/export\.(?P<export_format>geojson|csv)$',
+        shape_export,
+        name='lizard_shape.export'),
+    url(r'^shape/(?P<slug>[^/]+)/tiles/(?P<legend_type>\w+)/'
+        r'(?P<legend_id>\d+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$',
+        shape_tile,
+        name='lizard_shape.tile'),
+    url(r'^shape/(?P<slug>[^/]+)/mvt/'
+        r'(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf$',
+        shape_vector_tile,
+        name='lizard_shape.vector_tile'),
     )
 
 if getattr(settings, 'LIZARD_SHAPE_STANDALONE', False):
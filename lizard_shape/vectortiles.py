@@ -0,0 +1,182 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+"""
+Mapbox vector tiles (XYZ, google) of shapes.
+
+A tile has one layer, named after the slug of the shape, with the
+features in the tile clipped to it (plus a buffer) and simplified to
+the tile resolution. Features have the columns of the ShapeFields of
+the shape's template and the value fields of its legends as
+properties, so the client can draw every legend.
+
+Features are read from the simplified google levels (see
+lizard_shape.pyramid) if they are there. Tiles are cached on disk next
+to the png tiles, see lizard_shape.tiles.
+"""
+import hashlib
+import logging
+import os
+
+from shapely.geometry import box
+from shapely.wkb import loads
+try:
+    from shapely.errors import TopologicalError
+except ImportError:
+    # Shapely < 1.6.
+    from shapely.geos import TopologicalError
+import mapbox_vector_tile
+import osgeo.ogr
+
+from lizard_shape.indexes import ignore_fields
+from lizard_shape.indexes import shapefile_schema
+from lizard_shape.projections import shape_projection
+from lizard_shape.pyramid import pyramid_levels
+from lizard_shape.reprojected import google_transformation
+from lizard_shape.tiles import TILE_CACHE_DIR
+from lizard_shape.tiles import read_tile
+from lizard_shape.tiles import tile_bounds
+from lizard_shape.tiles import tile_filename
+from lizard_shape.tiles import tiles_written
+from lizard_shape.tiles import write_tile
+
+logger = logging.getLogger(__name__)
+
+# Change when the content of tiles changes, to invalidate cached tiles.
+VERSION = 1
+EXTENT = 4096
+# Buffer around the tile, in tile coordinates.
+BUFFER = 64
+# Scale denominator of a 256 pixel tile at zoom level 0.
+SCALE_AT_ZOOM_0 = 559082264.028
+
+
+def tile_fields(shape):
+    """Return the columns to include in the vector tiles of shape."""
+    template = shape.template
+    fields = [shape_field.field
+              for shape_field in template.shapefield_set.all()]
+    for legends in (template.shapelegend_set.all(),
+                    template.shapelegendpoint_set.all(),
+                    template.shapelegendclass_set.all()):
+        for legend in legends:
+            if legend.value_field not in fields:
+                fields.append(legend.value_field)
+    return fields
+
+
+def _source(shp_filename, z):
+    """Return (filename, in google) of the shapefile to read tiles at
+    zoom level z from."""
+    scale = SCALE_AT_ZOOM_0 / 2 ** z
+    for min_scale, max_scale, filename in pyramid_levels(shp_filename):
+        if ((min_scale is None or scale >= min_scale) and
+            (max_scale is None or scale < max_scale)):
+            return filename, True
+    return shp_filename, False
+
+
+def _property(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return value
+
+
+def tile_features(shape, z, x, y, fields):
+    """Return the features of tile z, x, y of shape for
+    mapbox_vector_tile.encode, with geometries in google."""
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    buffer_size = (maxx - minx) * BUFFER / EXTENT
+    clip_box = box(minx - buffer_size, miny - buffer_size,
+                   maxx + buffer_size, maxy + buffer_size)
+    # One tile coordinate.
+    tolerance = (maxx - minx) / EXTENT
+
+    filename, in_google = _source(shape.shp_file.path, z)
+    ds = osgeo.ogr.Open(filename)
+    if ds is None:
+        raise IOError("Could not open shapefile %s" % filename)
+    lyr = ds.GetLayer()
+    schema = shapefile_schema(filename, lyr)
+    field_indexes = [(field, schema.get(field)) for field in fields
+                     if field in schema]
+    ignore_fields(lyr, schema, [field for field, _ in field_indexes])
+    if in_google:
+        transformation = None
+        lyr.SetSpatialFilterRect(*clip_box.bounds)
+    else:
+        transformation = google_transformation(shape.prj)
+        projection = shape_projection(shape.prj)
+        bounds = clip_box.bounds
+        corners = [projection.from_google(corner_x, corner_y)
+                   for corner_x in (bounds[0], bounds[2])
+                   for corner_y in (bounds[1], bounds[3])]
+        lyr.SetSpatialFilterRect(
+            min(corner_x for corner_x, _ in corners),
+            min(corner_y for _, corner_y in corners),
+            max(corner_x for corner_x, _ in corners),
+            max(corner_y for _, corner_y in corners))
+
+    features = []
+    lyr.ResetReading()
+    feat = lyr.GetNextFeature()
+    while feat is not None:
+        geom = feat.GetGeometryRef()
+        if geom:
+            if transformation is not None:
+                geom.Transform(transformation)
+            geometry = loads(bytes(geom.ExportToWkb()))
+            if not geometry.is_valid:
+                # I.e. self-intersecting polygons, GEOS can't clip them.
+                geometry = geometry.buffer(0)
+            try:
+                geometry = geometry.intersection(clip_box)
+            except (TopologicalError, ValueError):
+                logger.warning("Skipping invalid geometry of feature %d "
+                               "in %s.", feat.GetFID(), filename)
+                geometry = None
+            if geometry is not None and not geometry.is_empty:
+                properties = {}
+                for field, field_index in field_indexes:
+                    value = feat.GetField(field_index)
+                    if value is not None:
+                        properties[field] = _property(value)
+                features.append({
+                        'geometry': geometry.simplify(
+                            tolerance, preserve_topology=True),
+                        'properties': properties,
+                        'id': feat.GetFID()})
+        feat = lyr.GetNextFeature()
+    return features
+
+
+def encode_tile(shape, z, x, y, fields):
+    """Return vector tile z, x, y of shape as protobuf data."""
+    return mapbox_vector_tile.encode(
+        {'name': str(shape.slug),
+         'features': tile_features(shape, z, x, y, fields)},
+        quantize_bounds=tile_bounds(z, x, y),
+        extents=EXTENT)
+
+
+def get_vector_tile(shape, z, x, y, directory=None):
+    """Return vector tile z, x, y of shape, from the cache or encoded."""
+    shp_filename = shape.shp_file.path
+    fields = tile_fields(shape)
+    config = (VERSION, shp_filename, os.path.getmtime(shp_filename),
+              shape.slug, fields)
+    filename = tile_filename(
+        os.path.join(directory or TILE_CACHE_DIR, str(shape.id),
+                     'mvt-' + hashlib.md5(
+                    repr(config).encode('utf-8')).hexdigest()),
+        z, x, y, 'pbf')
+    data = read_tile(filename)
+    if data is not None:
+        return data
+
+    data = encode_tile(shape, z, x, y, fields)
+    try:
+        write_tile(filename, data)
+    except (IOError, OSError):
+        logger.exception("Could not write vector tile %s.", filename)
+    else:
+        tiles_written(len(data), directory)
+    return data
@@ -1,9 +1,54 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.txt.
+import json
+import os
 
 from django.core.urlresolvers import reverse
+from django.http import Http404
+from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from lizard_map.views import AppView
+from lizard_shape.export import ExportError
+from lizard_shape.export import feature_chunks
+from lizard_shape.export import iter_csv
+from lizard_shape.export import iter_geojson
+from lizard_shape.layers import AdapterShapefile
+from lizard_shape.layers import LEGEND_MODELS
 from lizard_shape.models import Category
+from lizard_shape.models import Shape
+from lizard_shape.tiles import get_tile
+from lizard_shape.tiles import valid_tile
+from lizard_shape.vectortiles import get_vector_tile
+
+
+def _check_shapefile(shape):
+    """Raise Http404 if the shapefile of shape does not exist."""
+    try:
+        shp_filename = shape.shp_file.path
+    except ValueError:
+        # No file.
+        raise Http404
+    if not os.path.exists(shp_filename):
+        raise Http404
+
+
+def combined_adapter_layer_json(shape, legends):
+    """
+    Return adapter_layer_json that draws all legends on shape, through
+    one mapnik layer with a style per legend.
+    """
+    layer_arguments = json.loads(legends[0].adapter_layer_json(shape))
+    layer_arguments['layer_name'] = ' + '.join(
+        str(legend) for legend in legends)
+    layer_arguments['extra_legends'] = []
+    for legend in legends[1:]:
+        extra = json.loads(legend.adapter_layer_json(shape))
+        layer_arguments['extra_legends'].append(
+            {'legend_type': extra['legend_type'],
+             'legend_id': extra['legend_id'],
+             'value_field': extra['value_field']})
+    return json.dumps(layer_arguments)
 
 
 def shape_treeitems(shapes):
@@ -49,6 +94,18 @@ def shape_treeitems(shapes):
                  'adapter_layer_json':
                  shapelegendclass.adapter_layer_json(shape)})
 
+        # All legends at once, sharing the shapefile.
+        legends = (list(shapelegends) + list(shapelegendclasses) +
+                   list(shapelegendpoints))
+        if len(legends) > 1:
+            children.append(
+                {'name': '%s - %s' % (
+                        shape.name, ' + '.join(str(l) for l in legends)),
+                 'description': shape.description,
+                 'type': 'shape',
+                 'adapter_layer_json':
+                 combined_adapter_layer_json(shape, legends)})
+
     return children
 
 
@@ -98,3 +155,83 @@ class HomepageView(AppView):
 
     def shapes_tree(self):
         return get_tree(self.parent_category())
+
+
+def shape_export(request, slug, export_format):
+    """
+    Stream the features of a shape as GeoJSON or CSV.
+
+    Optional GET parameters:
+    - bbox=minx,miny,maxx,maxy (in srs)
+    - id=<id>, can be repeated
+    - attribute=<column>&value=<value>
+    - srs=wgs84 (default) or google
+    """
+    shape = get_object_or_404(Shape, slug=slug)
+
+    bbox = None
+    if 'bbox' in request.GET:
+        try:
+            bbox = [float(c) for c in request.GET['bbox'].split(',')]
+        except ValueError:
+            bbox = []
+        if len(bbox) != 4:
+            return HttpResponseBadRequest('Invalid bbox.')
+    attribute = request.GET.get('attribute', None)
+    _check_shapefile(shape)
+
+    try:
+        chunks = feature_chunks(
+            shape,
+            bbox=bbox,
+            ids=request.GET.getlist('id') or None,
+            attribute=attribute,
+            value=request.GET.get('value', ''),
+            srs=request.GET.get('srs', 'wgs84'))
+    except ExportError as e:
+        return HttpResponseBadRequest(str(e))
+
+    if export_format == 'csv':
+        fields = [shape_field.field for shape_field in
+                  shape.template.shapefield_set.all()]
+        response = StreamingHttpResponse(
+            iter_csv(chunks, fields), content_type='text/csv')
+    else:
+        response = StreamingHttpResponse(
+            iter_geojson(chunks), content_type='application/json')
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+        shape.slug, export_format)
+    return response
+
+
+def shape_tile(request, slug, legend_type, legend_id, z, x, y):
+    """
+    Png tile z/x/y (XYZ, google) of a shape with one of its legends,
+    from the tile cache.
+    """
+    shape = get_object_or_404(Shape, slug=slug)
+    if legend_type not in LEGEND_MODELS:
+        raise Http404
+    legend = get_object_or_404(LEGEND_MODELS[legend_type], pk=legend_id,
+                               shape_template=shape.template)
+    z, x, y = int(z), int(x), int(y)
+    if not valid_tile(z, x, y):
+        raise Http404
+    _check_shapefile(shape)
+    adapter = AdapterShapefile(
+        None, layer_arguments=json.loads(legend.adapter_layer_json(shape)))
+    return HttpResponse(get_tile(adapter, z, x, y), content_type='image/png')
+
+
+def shape_vector_tile(request, slug, z, x, y):
+    """
+    Mapbox vector tile z/x/y (XYZ, google) of a shape, from the tile
+    cache.
+    """
+    shape = get_object_or_404(Shape, slug=slug)
+    z, x, y = int(z), int(x), int(y)
+    if not valid_tile(z, x, y):
+        raise Http404
+    _check_shapefile(shape)
+    return HttpResponse(get_vector_tile(shape, z, x, y),
+                        content_type='application/x-protobuf')
@@ -15,9 +15,11 @@ install_requires = [
     'lizard-ui >= 4.0',
     'lizard-map >= 4.0',
     'lizard-wms',
+    'mapbox-vector-tile',
     'django-nose',
     'django-treebeard',
     'nens',
+    'numpy',
     'shapely',
     'south',
     'GDAL',